@@ -1,3 +1,3 @@
 #!/bin/bash
 DIR=$( cd "$( dirname "${BASH_SOURCE[0]}" )" && pwd)
-python  "$DIR/src/main.py"
\ No newline at end of file
+python  "$DIR/src/main.py" "$@"
\ No newline at end of file
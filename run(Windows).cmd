@@ -1,2 +1,2 @@
-C:\Python27\python "%~dp0\src\main.py"
+C:\Python27\python "%~dp0\src\main.py" %*
 pause
\ No newline at end of file
@@ -11,5 +11,13 @@ class Common(object):
     saved_maps_dir = None
     # Controls the edit phase of the main class
     edit_phase = False
-    # 2D list of all tiles
-    tile_map = []
\ No newline at end of file
+    # Grid of all tiles (a tilemap.TileMap)
+    tile_map = None
+    # Number of worker processes used to generate maps
+    workers = 1
+    # Size of the tiles (in pixels) in saved map images
+    image_tile_size = 90
+    # Format maps are saved in (see mapfile.extensions)
+    map_format = "binary"
+    # Path of the tile texture atlas description (see textures.TextureAtlas), None for flat colors
+    texture_atlas = None
@@ -1,12 +1,62 @@
 #!/usr/bin/python
-"""Credit goes to Ryan (1egoman) for the majority of the gen_map, 
-generate_noise, smooth_noise, and turbulence function code below.
+"""Credit goes to Ryan (1egoman) for the majority of the gen_map and
+classify_tiles function code below.
 """
 import os
 import random
+import multiprocessing
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
-from lib import easygui
 import common
+import tilemap
+import noisegen
+
+
+# Map generator used by a worker process of MapGenerator.gen_map_parallel()
+band_generator = None
+
+
+def init_band_worker(params, map_noise):
+    """Sets up the map generator of a worker process."""
+    global band_generator
+    band_generator = MapGenerator(common.Common(), dict(params))
+    if map_noise is not None:
+        band_generator.engine.set_map_noise(map_noise)
+
+
+def gen_band(band):
+    """Generates the rows from band[0] up to band[1] of a map in a worker
+    process.  Returns the tiles, for classic maps the tiaga forest tiles
+    whose grass draw is left to the main process, and the tile noise and
+    biome noise of the rows (so the main process can cache them).
+    """
+    y_start, y_end = band
+    generator = band_generator
+    width = generator.params['width']
+    if generator.params['mode'] == "world":
+        # The same noise gen_region() makes, including the column to the west
+        noise, biomenoise = generator.engine.region_noise(-1, y_start, width+1, y_end - y_start)
+        return generator.classify_local(noise, biomenoise, 0, y_start), [], noise, biomenoise
+    noise, biomenoise = generator.engine.map_noise(y_start, y_end)
+    # Remember the tiaga tiles instead of drawing random numbers out of order
+    tiaga_tiles = []
+    def tiaga_grass(x, y):
+        tiaga_tiles.append((x, y))
+        return False
+    return generator.classify_classic(noise, biomenoise, y_start, tiaga_grass), tiaga_tiles, noise, biomenoise
+
+
+def join_rows(grids):
+    """Joins grids of noise (NumPy arrays, or lists of rows without NumPy)
+    of consecutive rows into one grid.
+    """
+    if numpy is not None:
+        return numpy.concatenate(grids)
+    return [row for grid in grids for row in grid]
 
 
 
@@ -14,17 +64,36 @@ class MapGenerator(object):
     """Handles generation and regeneration of the maps."""
     # Dictionary of generator parameters
     params = {}
+    # Random number generator used only by this generator
+    rng = None
+    # Water tile upper limit/value for both biome and tile generation
+    watertable = 110
+    # Biome type levels/limits
+    biome_desert_level = 85
+    biome_swamp_level = 100
+    biome_forest_level = 125
+    biome_flatland_level = 150
+    biome_tiaga_level = 175
+    biome_mountain_level = 255
+    # Tile type threshholds/limits
+    sandlevel = watertable+10
+    forestlevel = 150
+    mtnlevel = 180
+    # Levels a map can change in its parameters (defaults are the ones above)
+    level_names = ("watertable", "sandlevel", "biome_desert_level", "biome_swamp_level",
+                   "biome_forest_level", "biome_flatland_level", "biome_tiaga_level",
+                   "biome_mountain_level")
+    # Biomes in the order of their numbers in classify_grid()
+    biome_names = ("aquatic", "desert", "swamp", "forest", "grassland", "tiaga", "mountain", "unknown")
 
 
     def __init__(self, common_inst, map_data):
         # Reference to shared data object
         self.common = common_inst
+        # Noise of the last generated map, with the settings it was made with
+        self.noise_cache = None
         # Change generation values
         self.set_params(map_data)
-        # Generation-specific stuff
-        self.noise = []
-        self.noise_width = 0
-        self.noise_height = 0
 
 
     def set_params(self, params):
@@ -33,40 +102,257 @@ class MapGenerator(object):
         # Randomize seed if left blank
         if self.params['seed'] is None:
             self.params['seed'] = str(random.randint(1000,1000000000))
-        # Set the seed for the random number generator
-        random.seed(self.params['seed'])
+        # Maps are 'classic' (one wrapped noise array per map) unless told otherwise
+        self.params.setdefault('mode', "classic")
+        # Rules that turn noise into tiles; world maps always use 'local' rules
+        self.params.setdefault('rules', "sequential")
+        if self.params['mode'] == "world":
+            self.params['rules'] = "local"
+        # Fused maps make tile noise and biome noise together from one noise array
+        self.params.setdefault('fused', False)
+        # Tile and biome levels; sand starts just above the map's water
+        for name in self.level_names:
+            if name == "sandlevel":
+                self.params.setdefault(name, self.params['watertable']+10)
+            else:
+                self.params.setdefault(name, getattr(self, name))
+        # Create this generator's own seeded random number generator
+        self.rng = random.Random(self.params['seed'])
+        # Key for the hashed noise of 'world' mode maps
+        self.world_key = random.Random(self.params['seed']).getrandbits(32)
+        # Create the noise engine the map uses
+        self.params.setdefault('engine', "value")
+        if self.params['engine'] not in noisegen.engines:
+            raise ValueError("Unknown noise engine: " + str(self.params['engine']))
+        self.engine = noisegen.engines[self.params['engine']](self)
+        if self.params['fused'] and not self.engine.fused:
+            raise ValueError("The {0} noise engine can not make fused maps".format(self.params['engine']))
 
 
     # TODO: Test if this will have issues with larger maps (OS thinks program crahsed, etc)
-    def gen_map(self):
-        """Generates a map and stores it in the common/shared class."""
-        # Clear the list of tiles
-        self.common.tile_map = []
+    def gen_map(self, workers=1):
+        """Generates a map and stores it in the common/shared class.  With
+        more than one worker, rows of the map are generated in parallel by a
+        pool of worker processes.
+        """
+        # Clear the tiles of the old map
+        self.common.tile_map = None
         print "Generating Map..."
-        # Water tile upper limit/value for both biome and tile generation
-        watertable = 110
-        # Biome type levels/limits
-        biome_desert_level = 85
-        biome_swamp_level = 100
-        biome_forest_level = 125
-        biome_flatland_level = 150
-        biome_tiaga_level = 175
-        biome_mountain_level = 255
-        # Tile type threshholds/limits
-        sandlevel = watertable+10
-        forestlevel = 150
-        mtnlevel = 180
-        # Used by noise generator
-        octaves = 200
-        # Generate tile noise and biome noise
-        noise = self.generate_noise(self.params['width'], self.params['height'], 10, octaves)
-        biomenoise = self.generate_noise(self.params['width'], self.params['height'], 5, octaves/3)
+        # Only the levels changed since the last map, so reuse its noise
+        if self.noise_cache is not None and self.noise_cache[0] == self.noise_settings():
+            settings, noise, biomenoise, rng_state = self.noise_cache
+            # Continue the random sequence from where making the noise left it
+            self.rng.setstate(rng_state)
+        elif workers > 1:
+            self.common.tile_map, noise, biomenoise, rng_state = self.gen_map_parallel(workers)
+            self.noise_cache = (self.noise_settings(), noise, biomenoise, rng_state)
+            print "Map Generated"
+            return
+        else:
+            # Generate tile noise and biome noise
+            noise, biomenoise = self.map_noise()
+            self.noise_cache = (self.noise_settings(), noise, biomenoise, self.rng.getstate())
+        # World maps are just the region of the world at the origin
+        if self.params['mode'] == "world":
+            self.common.tile_map = self.classify_local(noise, biomenoise, 0, 0)
+        else:
+            # Random grass tiles in tiaga biomes come from the generator's random sequence
+            tiaga_grass = lambda x, y: self.rng.randrange(0, 3) == 0
+            self.common.tile_map = self.classify_classic(noise, biomenoise, 0, tiaga_grass)
+        print "Map Generated"
+
+
+    def map_noise(self):
+        """Returns the tile noise and biome noise of the whole map.  For world
+        maps it includes the column to the west of the map.
+        """
+        width = self.params['width']
+        height = self.params['height']
+        if self.params['mode'] == "world":
+            return self.engine.region_noise(-1, 0, width+1, height)
+        self.engine.draw_map_noise(width, height)
+        noise = self.engine.map_noise(0, height)
+        self.engine.forget_map_noise()
+        return noise
+
+
+    def noise_settings(self):
+        """Returns everything the noise of a map depends on, to tell if
+        cached noise can be used for it.
+        """
+        return (self.params['seed'], self.params['width'], self.params['height'],
+                self.params['mode'], self.params['fused'], self.params['engine'],
+                self.engine.tile_noise, self.engine.biome_noise)
+
+
+    def gen_map_parallel(self, workers):
+        """Generates the map in bands of rows using a pool of worker
+        processes.  Returns the tiles, the tile noise and biome noise, and
+        the state of the random number generator after making the noise (as
+        gen_map() caches them).  The result is identical to generating the
+        map in this process.
+        """
+        width = self.params['width']
+        height = self.params['height']
+        # Classic maps need any random noise values drawn here, in order
+        map_noise = None
+        if self.params['mode'] != "world":
+            map_noise = self.engine.draw_map_noise(width, height)
+        # A few bands per worker so faster workers can pick up more of them
+        band_count = min(height, workers*4)
+        bands = [(height*n/band_count, height*(n+1)/band_count) for n in range(0, band_count)]
+        pool = multiprocessing.Pool(workers, init_band_worker, (self.params, map_noise))
+        try:
+            results = pool.map(gen_band, bands)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            self.engine.forget_map_noise()
+
+        rng_state = self.rng.getstate()
+        tile_map = tilemap.TileMap(width, height)
+        for (y_start, y_end), (tiles, tiaga_tiles, noise, biomenoise) in zip(bands, results):
+            # Draw the tiaga grass tiles in the same order gen_map() would
+            for x, y in tiaga_tiles:
+                if self.rng.randrange(0, 3) == 0:
+                    tiles.set(x, y, "grass")
+            tile_map.paste(tiles, 0, y_start)
+        noise = join_rows([result[2] for result in results])
+        biomenoise = join_rows([result[3] for result in results])
+        return tile_map, noise, biomenoise, rng_state
+
+
+    def gen_chunk(self, cx, cy, size):
+        """Returns a tile map of one square chunk of a 'world' mode map.  The
+        chunk is identical to the same region of a single larger map, so
+        chunks can be generated separately and in any order.
+        """
+        return self.gen_region(cx*size, cy*size, size, size)
+
+
+    def gen_region(self, x, y, width, height):
+        """Returns a tile map of a region of a 'world' mode map.  Every tile
+        only depends on the seed and its own coordinates.
+        """
+        if self.params['mode'] != "world":
+            raise ValueError("Only 'world' mode maps can be generated in parts")
+        # Generate tile noise and biome noise, including the column to the west
+        noise, biomenoise = self.engine.region_noise(x-1, y, width+1, height)
+        return self.classify_local(noise, biomenoise, x, y)
+
+
+    def classify_classic(self, noise, biomenoise, y, tiaga_grass):
+        """Turns the noise of the rows of a classic map starting at row y
+        into tiles, using the map's rules.  tiaga_grass is only used by
+        'sequential' rules.
+        """
+        if self.params['rules'] != "local" and numpy is None:
+            return self.classify_tiles(noise, biomenoise, tiaga_grass)
+        # The map wraps around, so the last column is to the west of the first
+        if numpy is not None:
+            noise = numpy.concatenate((noise[:,-1:], noise), axis=1)
+            biomenoise = numpy.concatenate((biomenoise[:,-1:], biomenoise), axis=1)
+        else:
+            noise = [row[-1:] + row for row in noise]
+            biomenoise = [row[-1:] + row for row in biomenoise]
+        if self.params['rules'] == "local":
+            return self.classify_local(noise, biomenoise, 0, y)
+        # Sequential rules only need the tiaga grass tiles drawn in scan order;
+        # the biome of a water tile never changes its tile.
+        return self.classify_grid(noise, biomenoise, lambda tiaga: self.scan_tiaga_grass(tiaga, tiaga_grass))
+
+
+    def classify_local(self, noise, biomenoise, x, y):
+        """Turns noise into tiles using 'local' rules, where every tile only
+        depends on its coordinates and its neighbors.  The first column of
+        the noise is the column to the west of the tiles; x and y are the
+        map coordinates of the first tile.
+        """
+        # Random grass tiles in tiaga biomes are picked by tile coordinates
+        tiaga_key = self.field_key(2)
+        if numpy is not None:
+            noise = numpy.asarray(noise)
+            xs = numpy.arange(x, x + noise.shape[1] - 1, dtype=numpy.int64)[numpy.newaxis,:]
+            ys = numpy.arange(y, y + noise.shape[0], dtype=numpy.int64)[:,numpy.newaxis]
+            hashed_grass = noisegen.lattice_hash(tiaga_key, xs, ys) % 3 == 0
+            return self.classify_grid(noise, numpy.asarray(biomenoise), lambda tiaga: tiaga & hashed_grass)
+        # Without NumPy use the tile by tile loop.  The biome of a water tile
+        # never changes its tile, so the scan order swamp rule doesn't matter.
+        tiaga_grass = lambda tx, ty: noisegen.lattice_hash(tiaga_key, x+tx, y+ty) % 3 == 0
+        return self.classify_tiles([row[1:] for row in noise], [row[1:] for row in biomenoise], tiaga_grass)
+
+
+    def classify_grid(self, noise, biomenoise, tiaga_grass):
+        """Vectorized classification of tiles.  The first column of the noise
+        is the column to the west of the tiles.  Water tiles take the swamp
+        biome when the tile to their west is swamp land.  tiaga_grass gets an
+        array telling which tiles are tiaga forest, and returns an array
+        telling which of them become grass.
+        """
+        # Biomes of land tiles
+        levels = [self.params[name] for name in self.level_names[2:]]
+        biome = numpy.select([biomenoise <= level for level in levels], range(1, 7), 7)
+        # Biomes of water tiles
+        water = noise <= self.params['watertable']
+        swamp_land = (biome == 2) & ~water
+        biome[:,1:][water[:,1:]] = 0
+        biome[:,1:][water[:,1:] & swamp_land[:,:-1]] = 2
+        # Drop the column to the west
+        noise = noise[:,1:]
+        biome = biome[:,1:]
+        water = water[:,1:]
+
+        tiaga = (biome == 5) & ~water & (noise > self.params['sandlevel'])
+        grass = tiaga_grass(tiaga)
+        tile_map = tilemap.TileMap(noise.shape[1], noise.shape[0])
+        tiles = numpy.select([
+            water,
+            (noise <= self.params['sandlevel']) | (biome == 1),
+            biome == 6,
+            ((biome == 3) | (biome == 5)) & ~grass,
+            noise > self.params['sandlevel']
+            ], [tile_map.ids[name] for name in ("water", "sand", "mountainhigh", "forest", "grass")],
+            tile_map.ids["none"])
+        tile_map.as_array()[:] = tiles
+        return tile_map
+
+
+    def scan_tiaga_grass(self, tiaga, tiaga_grass):
+        """Calls tiaga_grass(x, y) for each tiaga forest tile in scan order,
+        like the tile by tile loop does, and returns an array of the results.
+        """
+        grass = numpy.zeros(tiaga.shape, dtype=bool)
+        for y, x in zip(*numpy.nonzero(tiaga)):
+            grass[y, x] = tiaga_grass(int(x), int(y))
+        return grass
+
+
+    def classify_tiles(self, noise, biomenoise, tiaga_grass):
+        """Turns tile noise and biome noise into a tile map.
+        tiaga_grass(x, y) decides if a tiaga forest tile becomes grass.
+        """
+        # The tile by tile loop is much faster on lists than on arrays
+        if numpy is not None:
+            noise = numpy.asarray(noise).tolist()
+            biomenoise = numpy.asarray(biomenoise).tolist()
+        tile_map = tilemap.TileMap(len(noise[0]) if noise else 0, len(noise))
+        watertable = self.params['watertable']
+        biome_desert_level = self.params['biome_desert_level']
+        biome_swamp_level = self.params['biome_swamp_level']
+        biome_forest_level = self.params['biome_forest_level']
+        biome_flatland_level = self.params['biome_flatland_level']
+        biome_tiaga_level = self.params['biome_tiaga_level']
+        biome_mountain_level = self.params['biome_mountain_level']
+        sandlevel = self.params['sandlevel']
         allowaquatic = True
         nbiome = None
 
-        for x,c in enumerate(noise):
+        for y,c in enumerate(noise):
             column = []
-            for y,d in enumerate(c):
+            for x,d in enumerate(c):
                 # Generate biomes #
                 # Water biome
                 if d <= watertable:
@@ -76,28 +362,28 @@ class MapGenerator(object):
                         biome = nbiome
                         allowaquatic = True
                 # Desert biome
-                elif biomenoise[x][y] <= biome_desert_level:
+                elif biomenoise[y][x] <= biome_desert_level:
                     biome = "desert"
                     allowaquatic = True
                 # Swamp biome
-                elif biomenoise[x][y] <= biome_swamp_level:
+                elif biomenoise[y][x] <= biome_swamp_level:
                     biome = "swamp"
                     allowaquatic = False
                     nbiome = "swamp"
                 # Forest biome
-                elif biomenoise[x][y] <= biome_forest_level:
+                elif biomenoise[y][x] <= biome_forest_level:
                     biome = "forest"
                     allowaquatic = True
                 # Grassland biome
-                elif biomenoise[x][y] <= biome_flatland_level:
+                elif biomenoise[y][x] <= biome_flatland_level:
                     biome = "grassland"
                     allowaquatic = True 
                 # Tiaga biome
-                elif biomenoise[x][y] <= biome_tiaga_level:
+                elif biomenoise[y][x] <= biome_tiaga_level:
                     biome = "tiaga"
                     allowaquatic = True
                 # Mountain biome
-                elif biomenoise[x][y] <= biome_mountain_level:
+                elif biomenoise[y][x] <= biome_mountain_level:
                     biome = "mountain"
                     allowaquatic = True
                 # Unspecified biome type
@@ -115,13 +401,13 @@ class MapGenerator(object):
                     tile = "sand"
                     # sand
                 # Mountain tile
-                elif d > sandlevel and biome == "mountain": # biomenoise[x][y] > mtnlevel
+                elif d > sandlevel and biome == "mountain": # biomenoise[y][x] > mtnlevel
                     tile = "mountainhigh"
                     # mountains
                 # Forest/grass tile
                 elif d > sandlevel and (biome == "forest" or biome == "tiaga"):
                     tile = "forest"
-                    if biome == "tiaga" and random.randrange(0, 3) == 0:
+                    if biome == "tiaga" and tiaga_grass(x, y):
                         tile = "grass"
                     # forest
                 # Grass tile
@@ -136,65 +422,10 @@ class MapGenerator(object):
                 # Add tile to current row/column list
                 column.append(tile)
             # Add column/row to tile map
-            self.common.tile_map.append(column)
-        print "Map Generated"
-
-
-    def generate_noise(self, width, height, frequency, octaves):
-        """Generates a 2d array of random noise."""
-        del self.noise[:]
-        self.noise_width = width
-        self.noise_height = height
-
-        for y in range(0, self.noise_height):
-            noise_row = []
-            for x in range(0, self.noise_width):
-                noise_row.append(random.randint(0, 1000)/1000.0)
-            self.noise.append(noise_row)
-
-        result = []
-
-        for y in range(0, self.noise_height):
-            row = []
-            for x in range(0, self.noise_width):
-                row.append(self.turbulence(x*frequency, y*frequency, octaves))
-            result.append(row)
-
-        return result
-
-
-    def smooth_noise(self, x, y):
-        """ Returns the average value of the 4 neighbors of (x, y) from the
-        noise array.
-        """
-        fractX = x-int(x)
-        fractY = y-int(y)
-
-        x1 = (int(x)+self.noise_width) % self.noise_width
-        y1 = (int(y)+self.noise_height) % self.noise_height
-
-        x2 = (x1+self.noise_width - 1) % self.noise_width
-        y2 = (y1+self.noise_height - 1) % self.noise_height
-
-        value = 0.0
-        value += fractX * fractY * self.noise[y1][x1]
-        value += fractX * (1-fractY) * self.noise[y2][x1]
-        value += (1-fractX) * fractY * self.noise[y1][x2]
-        value += (1-fractX) * (1-fractY) * self.noise[y2][x2]
-
-        return value
-
-
-    def turbulence(self, x, y, size):
-        """This function controls how far we zoom in/out of the noise array.
-        The further zoomed in gives less detail and is more blurry.
-        """
-        value = 0.0
-        size *= 1.0
-        initial_size = size
+            tile_map.set_row(y, column)
+        return tile_map
 
-        while size >= 1:
-            value += self.smooth_noise(x / size, y / size) * size
-            size /= 2.0
 
-        return 128.0 * value / initial_size
\ No newline at end of file
+    def field_key(self, field):
+        """Returns the lattice_hash() key of one noise field of a world."""
+        return (self.world_key + field*0x9e3779b9) & 0xffffffff
@@ -1,7 +1,48 @@
 #!/usr/bin/python
+import os
+import struct
+import multiprocessing
+import multiprocessing.sharedctypes
+
 import pygame
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 import common
+import mapfile
+import pngwriter
+import textures
+
+
+# Tile pixel rows and shared output buffer of a worker process of Graphics.save_full_map()
+band_renderer = None
+
+
+def init_render_worker(tile_rows, buffer, slot_size):
+    """Sets up the band rendering of a worker process."""
+    global band_renderer
+    band_renderer = (tile_rows, buffer, slot_size)
+
+
+def render_band(band):
+    """Renders and compresses a band of rows of tiles of the full map image
+    in a worker process.  band is the slot of the shared buffer to store the
+    compressed data in, the width of the map and the tile IDs of the band
+    (a string, row by row).  Returns the length of the compressed data and
+    the other values returned by pngwriter.deflate_rows().
+    """
+    slot, width, ids = band
+    tile_rows, buffer, slot_size = band_renderer
+    rows = []
+    for y in range(0, len(ids)//width):
+        rows.extend(Graphics.render_strip(ids[y*width:(y+1)*width], tile_rows))
+    data, checksum, size, count = pngwriter.deflate_rows(rows)
+    if len(data) > slot_size:
+        raise ValueError("Compressed band does not fit in its buffer")
+    buffer[slot*slot_size:slot*slot_size + len(data)] = data
+    return len(data), checksum, size, count
 
 
 
@@ -16,46 +57,531 @@ class Graphics(object):
     "grass" : (1,142,14),
     "none" : (0,0,0)
     }
+    # Tile sizes (in pixels) the display window can be zoomed to, sizes
+    # below one pixel are drawn from the reduced levels of the map pyramid
+    zoom_levels = (1/64.0, 1/32.0, 1/16.0, 1/8.0, 1/4.0, 1/2.0, 1, 2, 3, 5, 10, 20, 40)
+    # Largest display window size
+    max_window_size = (1024, 768)
+    # Smallest tile size (in pixels) drawn with tile textures in the display window
+    texture_zoom = 8
+    # Size (in bytes) of the pixels of a band of the full map image rendered by a worker process
+    band_size = 1 << 24
+    # Title of the display window
+    caption = "Tile Map GenEditor"
+    # Rows of a new map level reduced at a time
+    reduce_rows = 64
+    # Largest map level (in pixels) made from a map whose tiles are read from
+    # a file as they are used, larger maps can not be zoomed out below one
+    # pixel per tile
+    max_lazy_level_size = 1 << 26
 
 
     def __init__(self, common_inst):
         # Reference to common instance
         self.common = common_inst
         # Setup display
-        pygame.display.set_caption("Tile Map GenEditor")
+        pygame.display.set_caption(self.caption)
+        # Limit the display window to most of the screen (leaving room for the task bar, etc.)
+        info = pygame.display.Info()
+        if info.current_w > 0 and info.current_h > 0:
+            self.max_window_size = (info.current_w*9//10, info.current_h*9//10)
+        # Size of the tiles in the display window, in pixels
+        self.zoom = 10
+        # Position of the view in the zoomed map, in pixels
+        self.camera = [0, 0]
+        # Map pyramid, level n has one pixel per 2**n by 2**n tiles (see MapLevel)
+        self.levels = []
+        # Version of the tile map the map pyramid shows
+        self.image_version = None
+        # Whether the display window has to be drawn again
+        self.display_dirty = True
+        # Tile textures (a textures.TextureAtlas), loaded when first needed
+        self.atlas = None
+        self.atlas_loaded = False
 
 
     def render_display(self):
-        """Renders the display window elements."""
-        # Render map preview #
-        # Determine tile size and window/map dimensions
-        tile_size = 10
-        width = len(self.common.tile_map[0])*tile_size  # number of tiles * size of tile
-        height = len(self.common.tile_map)*tile_size
-        map_preview = pygame.Surface((width, height))
-        # Draw the tiles to the surface #
-        for y,row in enumerate(self.common.tile_map):
-            for x,tile in enumerate(row):
-                pygame.draw.rect(map_preview, self.tile_colors[tile],
-                                (x*tile_size,y*tile_size,tile_size,tile_size))
-        # Adjust the display surface
-        pygame.display.set_mode((width,height))
-        # Draw map preview to display
-        pygame.display.get_surface().blit(map_preview, (0,0))
+        """Renders the display window elements.  Nothing is drawn unless the
+        tile map, the view or the window changed, or the display was
+        invalidated.
+        """
+        tile_map = self.common.tile_map
+        # Start a new map pyramid if the tile map changed
+        if tile_map.version != self.image_version:
+            # Show the whole map (or as much as fits) when switching maps
+            if not self.levels or (self.levels[0].width, self.levels[0].height) != (tile_map.width, tile_map.height):
+                self.zoom = 10
+                self.camera = [0, 0]
+            level = MapLevel(1, tile_map.width, tile_map.height, tile_map.data)
+            self.render_level(level)
+            self.levels = [level]
+            self.image_version = tile_map.version
+            self.display_dirty = True
+        # Nothing changed since the last time the display was drawn
+        if not self.display_dirty:
+            return
+        # Adjust the display surface, only if the window size changed
+        display = pygame.display.get_surface()
+        window_size = self.window_size()
+        if display is None or display.get_size() != window_size:
+            display = pygame.display.set_mode(window_size)
+        # Draw the visible part of the map to the display
+        level, pixel_size = self.view_level()
+        self.clamp_camera(level, pixel_size)
+        display.fill(self.tile_colors["none"])
+        self.draw_area(display, level, pixel_size, *self.visible_area(level, pixel_size))
         # Update the display
         pygame.display.flip()
+        self.display_dirty = False
+
+
+    def window_size(self):
+        """Returns the size of the display window: the size of the map at the
+        default zoom, but no larger than the screen.
+        """
+        max_width, max_height = self.max_window_size
+        return (min(self.common.tile_map.width*10, max_width),
+            min(self.common.tile_map.height*10, max_height))
+
+
+    def view_level(self):
+        """Returns the map pyramid level to draw at the current zoom, and the
+        size of its pixels in the display window.
+        """
+        n = 0
+        while self.zoom*2**n < 1:
+            n += 1
+        return self.get_level(n), int(self.zoom*2**n)
+
+
+    def get_level(self, n):
+        """Returns level n of the map pyramid, first making or updating the
+        levels below it as needed.
+        """
+        for n in range(1, n+1):
+            source = self.levels[n-1]
+            # Make a new level from the whole level below it
+            if n == len(self.levels):
+                level = MapLevel(source.scale*2, -(-source.width//2), -(-source.height//2))
+                # A band at a time, so only a band of the level below is read at once
+                for top in range(0, level.height, self.reduce_rows):
+                    self.reduce_area(source, level, 0, top, level.width, min(top + self.reduce_rows, level.height))
+                self.render_level(level)
+                self.levels.append(level)
+            # Reduce only the changed areas of an existing level again
+            else:
+                level = self.levels[n]
+                for left, top, right, bottom in level.dirty:
+                    left, top = left//level.scale, top//level.scale
+                    right, bottom = -(-right//level.scale), -(-bottom//level.scale)
+                    self.reduce_area(source, level, left, top, right, bottom)
+                    # Images sharing the tile IDs already show the changes
+                    if not level.shared:
+                        ids = bytearray()
+                        for y in range(top, bottom):
+                            ids += level.ids[y*level.width + left:y*level.width + right]
+                        level.image.blit(self.render_ids(ids, right-left, bottom-top), (left, top))
+                level.dirty = []
+        return self.levels[n]
+
+
+    def reduce_area(self, source, level, left, top, right, bottom):
+        """Sets the tile IDs of an area of a map level (in level pixels,
+        right and bottom not included) from the level below it.  Each pixel
+        gets the tile shown by most of the 2x2 pixels below it (requires
+        NumPy), or the top left one of them without NumPy.
+        """
+        if numpy is None:
+            for y in range(top, bottom):
+                start = 2*y*source.width
+                row = source.ids[start + 2*left:start + min(2*right, source.width):2]
+                level.ids[y*level.width + left:y*level.width + right] = row
+            return
+        # The 2x2 pixels below each pixel, repeating the last row/column of odd sized levels
+        if isinstance(source.ids, mapfile.LazyTiles):
+            source_right, source_bottom = min(2*right, source.width), min(2*bottom, source.height)
+            below = numpy.frombuffer(mapfile.area_tiles(source.ids, source.width, 2*left, 2*top, source_right, source_bottom),
+                dtype=numpy.uint8).reshape(source_bottom - 2*top, source_right - 2*left)
+        else:
+            below = numpy.frombuffer(source.ids, dtype=numpy.uint8).reshape(source.height, source.width)
+            below = below[2*top:2*bottom, 2*left:2*right]
+        if below.shape != (2*(bottom-top), 2*(right-left)):
+            below = numpy.pad(below, ((0, 2*(bottom-top) - below.shape[0]), (0, 2*(right-left) - below.shape[1])), "edge")
+        a, b = below[0::2, 0::2], below[0::2, 1::2]
+        c, d = below[1::2, 0::2], below[1::2, 1::2]
+        # Majority vote, ties go to the first of a, b and c
+        ids = numpy.where((b == c) | (b == d), b, a)
+        ids = numpy.where(c == d, c, ids)
+        ids = numpy.where((a == b) | (a == c) | (a == d), a, ids)
+        numpy.frombuffer(level.ids, dtype=numpy.uint8).reshape(level.height, level.width)[top:bottom, left:right] = ids
+
+
+    def visible_area(self, level, pixel_size):
+        """Returns the bounds (left, top, right, bottom) of the pixels of a
+        map level in view, right and bottom not included.
+        """
+        width, height = pygame.display.get_surface().get_size()
+        left = max(0, self.camera[0]//pixel_size)
+        top = max(0, self.camera[1]//pixel_size)
+        right = min(level.width, -(-(self.camera[0] + width)//pixel_size))
+        bottom = min(level.height, -(-(self.camera[1] + height)//pixel_size))
+        return left, top, right, bottom
+
+
+    def draw_area(self, display, level, pixel_size, left, top, right, bottom):
+        """Draws the pixels of a map level from left to right (not included)
+        and top to bottom (not included) to the display, and returns the area
+        drawn to.
+        """
+        if right <= left or bottom <= top:
+            return None
+        # Draw textured tiles one row at a time when zoomed in far enough
+        atlas = self.get_atlas()
+        if atlas is not None and level.scale == 1 and pixel_size >= self.texture_zoom:
+            tile_map = self.common.tile_map
+            tile_textures = atlas.textures_for(tile_map.palette, self.palette_colors(tile_map), pixel_size)
+            x = left*pixel_size - self.camera[0]
+            for y in range(top, bottom):
+                ids = level.ids[y*level.width + left:y*level.width + right]
+                position_y = y*pixel_size - self.camera[1]
+                textures.blit_all(display, [(tile_textures[tile_id], (x + n*pixel_size, position_y))
+                    for n, tile_id in enumerate(ids)])
+            area = pygame.Rect(x, top*pixel_size - self.camera[1], (right-left)*pixel_size, (bottom-top)*pixel_size)
+            return area.clip(display.get_rect())
+        # Scale only the part of the level image that is drawn (made from
+        # the tile IDs in view for levels without an image)
+        if level.image is None:
+            area = self.render_ids(mapfile.area_tiles(level.ids, level.width, left, top, right, bottom), right-left, bottom-top)
+        else:
+            area = level.image.subsurface((left, top, right-left, bottom-top))
+        area = pygame.transform.scale(area, ((right-left)*pixel_size, (bottom-top)*pixel_size))
+        return display.blit(area, (left*pixel_size - self.camera[0], top*pixel_size - self.camera[1]))
+
+
+    def clamp_camera(self, level, pixel_size):
+        """Keeps the view inside the map, or centers the map if it is smaller
+        than the display window.
+        """
+        width, height = pygame.display.get_surface().get_size()
+        map_size = (level.width*pixel_size, level.height*pixel_size)
+        for axis, window in enumerate((width, height)):
+            if map_size[axis] <= window:
+                self.camera[axis] = -((window - map_size[axis])//2)
+            else:
+                self.camera[axis] = min(max(self.camera[axis], 0), map_size[axis] - window)
+
+
+    def pan(self, dx, dy):
+        """Moves the view by the given number of pixels."""
+        self.camera[0] += int(dx)
+        self.camera[1] += int(dy)
+        self.display_dirty = True
+
+
+    def zoom_at(self, pos, steps):
+        """Zooms in (positive steps) or out (negative steps) by the given number
+        of zoom levels, keeping the tile at the window position pos in place.
+        """
+        levels = self.zoom_levels
+        # Nearest zoom level to the current zoom
+        current = min(range(0, len(levels)), key=lambda n: abs(levels[n] - self.zoom))
+        # Maps too large to make map levels of can not be zoomed out below one pixel per tile
+        lowest = 0
+        tile_map = self.common.tile_map
+        if isinstance(tile_map.data, mapfile.LazyTiles) and (tile_map.width//2)*(tile_map.height//2) > self.max_lazy_level_size:
+            lowest = levels.index(1)
+        zoom = levels[min(max(current + steps, lowest), len(levels) - 1)]
+        if zoom == self.zoom:
+            return
+        # Keep the point under pos in the same place
+        for axis in (0, 1):
+            point = (self.camera[axis] + pos[axis])/float(self.zoom)
+            self.camera[axis] = int(round(point*zoom)) - pos[axis]
+        self.zoom = zoom
+        self.display_dirty = True
+
+
+    def update_tiles(self, tiles):
+        """Draws only the given tiles again, in the map pyramid and in the
+        display window.  tiles is an iterable of the (x, y) coordinates of
+        all tiles changed since the display was last drawn.
+        """
+        tile_map = self.common.tile_map
+        # Draw everything if there is no map pyramid of this map yet
+        if not self.levels or (self.levels[0].width, self.levels[0].height) != (tile_map.width, tile_map.height):
+            self.render_display()
+            return
+        # Changing tiles may have added tile types to the palette
+        self.update_palette()
+        # Draw the changed tiles to the tile image, unless it shares the tile IDs of the map
+        tiles = list(tiles)
+        if not self.levels[0].shared:
+            colors = self.palette_colors(tile_map)
+            for x, y in tiles:
+                self.levels[0].image.set_at((x, y), colors[tile_map.data[y*tile_map.width + x]])
+        # Reduce the changed areas of the other levels again once they are drawn
+        blocks = self.tile_blocks(tiles)
+        for level in self.levels[1:]:
+            level.dirty.extend(blocks)
+        # The map pyramid now shows the current tiles
+        self.image_version = tile_map.version
+        # The whole display needs to be drawn anyway
+        if self.display_dirty or pygame.display.get_surface() is None:
+            self.render_display()
+            return
+        # Draw the changed areas that are in view, and update only those areas
+        display = pygame.display.get_surface()
+        level, pixel_size = self.view_level()
+        view_left, view_top, view_right, view_bottom = self.visible_area(level, pixel_size)
+        rects = []
+        for left, top, right, bottom in blocks:
+            # Bounds of the changed tiles in the pixels of the level
+            left, top = left//level.scale, top//level.scale
+            right, bottom = -(-right//level.scale), -(-bottom//level.scale)
+            rect = self.draw_area(display, level, pixel_size, max(left, view_left), max(top, view_top),
+                min(right, view_right), min(bottom, view_bottom))
+            if rect is not None:
+                rects.append(rect)
+        pygame.display.update(rects)
+
+
+    def tile_blocks(self, tiles, block_size=16):
+        """Returns the bounds (left, top, right, bottom) of the given tiles,
+        right and bottom not included.  Tiles in the same block of block_size
+        by block_size tiles share one bounds, so nearby changes are drawn
+        together.
+        """
+        blocks = {}
+        for x, y in tiles:
+            block = (x//block_size, y//block_size)
+            if block in blocks:
+                left, top, right, bottom = blocks[block]
+                blocks[block] = (min(left, x), min(top, y), max(right, x+1), max(bottom, y+1))
+            else:
+                blocks[block] = (x, y, x+1, y+1)
+        return blocks.values()
+
+
+    def set_tile_color(self, name, color):
+        """Changes the color of a tile type.  Only the palettes of the map
+        images change, so the map does not have to be rendered again.
+        """
+        # Copy the colors first, so other Graphics objects keep theirs
+        self.tile_colors = dict(self.tile_colors)
+        self.tile_colors[name] = color
+        self.update_palette()
+        # Textures made for tiles without a texture use the old color
+        if self.atlas is not None:
+            self.atlas.scaled.clear()
+        self.display_dirty = True
+
+
+    def update_palette(self):
+        """Sets the palette of the images of all map levels to the tile colors
+        of the current tile map.
+        """
+        colors = self.palette_colors(self.common.tile_map)
+        for level in self.levels:
+            if level.image is not None:
+                level.image.set_palette(colors)
+
+
+    def show_status(self, status=None):
+        """Shows a status (e.g. the progress of a save) in the title of the
+        display window, or only the title if status is None.
+        """
+        if status is None:
+            pygame.display.set_caption(self.caption)
+        else:
+            pygame.display.set_caption(self.caption + " - " + status)
+
+
+    def invalidate(self):
+        """Makes the next render_display() call draw the display window
+        again (e.g. after another window covered it).
+        """
+        self.display_dirty = True
+
+
+    def save_full_map(self, path, tile_size=None, workers=None, tile_map=None, progress=None):
+        """Saves the map (or tile_map, e.g. a snapshot of the map) in full
+        scale as a PNG image.  The image is rendered and written one row of
+        tiles at a time, so only that row is in memory.  With more than one
+        worker, bands of rows are rendered and compressed by a pool of worker
+        processes.  progress is called with the part of the image written so
+        far (0 to 1) after each row or band, if given.  The image is written
+        to a temporary file, which then replaces the file at path.
+        """
+        if tile_map is None:
+            tile_map = self.common.tile_map
+        if tile_size is None:
+            tile_size = self.common.image_tile_size
+        if workers is None:
+            workers = self.common.workers
+        # Pixel rows of each tile ID
+        tile_rows = self.tile_rows(tile_map, tile_size)
+        temp_path = path + ".tmp"
+        try:
+            with open(temp_path, "wb") as f:
+                writer = pngwriter.PNGWriter(f, tile_map.width*tile_size, tile_map.height*tile_size)
+                if workers > 1 and tile_map.height > 1:
+                    self.write_bands(writer, tile_map, tile_rows, workers, progress)
+                else:
+                    for y in range(0, tile_map.height):
+                        writer.write_rows(self.render_strip(tile_map.data[y*tile_map.width:(y+1)*tile_map.width], tile_rows))
+                        if progress is not None:
+                            progress((y+1)/float(tile_map.height))
+                writer.close()
+            mapfile.replace_file(temp_path, path)
+        except:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+
+    def write_bands(self, writer, tile_map, tile_rows, workers, progress=None):
+        """Renders bands of rows of tiles of the full map image in a pool of
+        worker processes, and writes them in order.  Workers get the tile IDs
+        of each band with the band (so the tile map is never copied to them,
+        and maps whose tiles are read from a file as they are used work too)
+        and return bands through a shared buffer with two slots per worker,
+        each slot being reused once its band is written.
+        """
+        tile_size = len(tile_rows[0])
+        # Bands of about band_size bytes of pixels
+        row_size = 1 + 3*tile_map.width*tile_size
+        band_height = max(1, min(self.band_size//(row_size*tile_size), -(-tile_map.height//workers)))
+        bands = [(top, min(top + band_height, tile_map.height)) for top in range(0, tile_map.height, band_height)]
+        # Room for a band, even if it can not be compressed at all
+        slot_size = band_height*tile_size*row_size*1001//1000 + 1024
+        slots = min(len(bands), 2*workers)
+        buffer = multiprocessing.sharedctypes.RawArray('c', slots*slot_size)
+        pool = multiprocessing.Pool(workers, init_render_worker, (tile_rows, buffer, slot_size))
+        try:
+            results = [pool.apply_async(render_band, (self.band_task(tile_map, n, bands[n]),)) for n in range(0, slots)]
+            for n in range(0, len(bands)):
+                slot = n % slots
+                length, checksum, size, count = results[n].get()
+                writer.write_deflated(buffer[slot*slot_size:slot*slot_size + length], checksum, size, count)
+                if progress is not None:
+                    progress(bands[n][1]/float(tile_map.height))
+                # The slot is free again, render the next band into it
+                if n + slots < len(bands):
+                    results.append(pool.apply_async(render_band, (self.band_task(tile_map, slot, bands[n + slots]),)))
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+
+    @staticmethod
+    def band_task(tile_map, slot, band):
+        """Returns the argument of render_band() for a band (top, bottom) of
+        rows of tiles, rendered into a slot of the shared buffer.
+        """
+        top, bottom = band
+        return slot, tile_map.width, str(tile_map.data[top*tile_map.width:bottom*tile_map.width])
+
+
+    def tile_rows(self, tile_map, tile_size):
+        """Returns the rows of RGB bytes of one tile, for each tile ID of a
+        tile map.
+        """
+        atlas = self.get_atlas()
+        if atlas is None:
+            return [[struct.pack("BBB", *color)*tile_size]*tile_size for color in self.palette_colors(tile_map)]
+        # Cut the pixels of each texture into rows
+        rows = []
+        row_size = 3*tile_size
+        for texture in atlas.textures_for(tile_map.palette, self.palette_colors(tile_map), tile_size):
+            pixels = pygame.image.tostring(texture, "RGB")
+            rows.append([pixels[n*row_size:(n+1)*row_size] for n in range(0, tile_size)])
+        return rows
+
+
+    @staticmethod
+    def render_strip(ids, tile_rows):
+        """Returns the pixel rows (strings of RGB bytes) of a row of tiles,
+        given their tile IDs, using the tile rows from tile_rows().
+        """
+        tiles = [tile_rows[tile_id] for tile_id in bytearray(ids)]
+        return ["".join([rows[n] for rows in tiles]) for n in range(0, len(tile_rows[0]))]
+
+
+    def get_atlas(self):
+        """Returns the tile textures, or None to draw tiles in flat colors
+        (no texture atlas set, or it could not be loaded).
+        """
+        if not self.atlas_loaded and self.common.texture_atlas is not None:
+            try:
+                self.atlas = textures.TextureAtlas(self.common.texture_atlas)
+            except (IOError, ValueError, KeyError, TypeError, pygame.error) as error:
+                print "Could not load the texture atlas \"{0}\": {1}".format(self.common.texture_atlas, error)
+            self.atlas_loaded = True
+        return self.atlas
+
+
+    def palette_colors(self, tile_map):
+        """Returns the colors of a tile map's tile IDs.  Tiles without a color
+        are drawn like "none" tiles.
+        """
+        none = self.tile_colors["none"]
+        return [self.tile_colors.get(name, none) for name in tile_map.palette]
+
+
+    def render_level(self, level):
+        """Makes the image of a map level: an 8 bit surface with the tile
+        colors as its palette, whose pixels are the tile IDs of the level.
+        Where pygame supports it, the image uses the tile IDs without copying
+        them, so it always shows the current tiles.  Tile IDs read from a
+        file as they are used (see mapfile.LazyTiles) get no image, only the
+        part of the level in view is drawn from them.
+        """
+        if isinstance(level.ids, mapfile.LazyTiles):
+            level.image = None
+            level.shared = True
+            return
+        try:
+            level.image = pygame.image.frombuffer(buffer(level.ids), (level.width, level.height), "P")
+            level.image.set_palette(self.palette_colors(self.common.tile_map))
+            level.shared = True
+        except (ValueError, TypeError, pygame.error):
+            level.image = self.render_ids(level.ids, level.width, level.height)
+            level.shared = False
+
+
+    def render_ids(self, ids, width, height):
+        """Returns an 8 bit surface with a copy of the tile IDs (of the
+        current tile map) in ids as its pixels, and the tile colors as its
+        palette.
+        """
+        image = pygame.image.fromstring(str(buffer(ids)), (width, height), "P")
+        image.set_palette(self.palette_colors(self.common.tile_map))
+        return image
+
 
 
-    def render_full_map(self):
-        """Renders the map in full scale and with tile textures (if applicable)."""
-        # Tile size
-        tile_size = 90
-        width = len(self.common.tile_map[0])*tile_size  # number of tiles * size of tile
-        height = len(self.common.tile_map)*tile_size
-        # Create the surface to draw to
-        full_map = pygame.Surface((width, height))
-        # Draw the tiles to the surface
-        for y,row in enumerate(self.common.tile_map):
-            for x,tile in enumerate(row):
-                pygame.draw.rect(full_map, self.tile_colors[tile], (x*tile_size,y*tile_size,tile_size,tile_size))
-        return full_map
\ No newline at end of file
+class MapLevel(object):
+    """One level of the map pyramid: the tile IDs and image of the map
+    reduced to one pixel per scale by scale tiles.
+    """
+    def __init__(self, scale, width, height, ids=None):
+        # Number of tiles along each side of a pixel (a power of two)
+        self.scale = scale
+        # Dimensions in pixels
+        self.width = width
+        self.height = height
+        # Tile ID shown by each pixel, row by row
+        if ids is None:
+            ids = bytearray(width*height)
+        self.ids = ids
+        # Image with one pixel per tile ID (see Graphics.render_level()),
+        # None if the level is drawn from its tile IDs
+        self.image = None
+        # Whether the image shares its pixels with ids
+        self.shared = False
+        # Bounds (left, top, right, bottom) of the changed areas, in tiles,
+        # that still have to be reduced again
+        self.dirty = []
@@ -0,0 +1,77 @@
+#!/usr/bin/python
+import os
+
+import pygame
+
+import common
+import genmap
+import graphics
+import mapfile
+
+
+
+class Headless(object):
+    """Runs the generate, render and save steps of the program from
+    generator data alone, without a display window or dialogs (for servers,
+    containers and batch jobs).
+    """
+    def __init__(self):
+        # Use SDL's dummy video driver, so no display is needed
+        os.environ["SDL_VIDEODRIVER"] = "dummy"
+        pygame.init()
+        # Initialize the object used for data used by multiple objects
+        self.common = common.Common()
+        # Determine the root directory of the program
+        self.common.root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        self.common.saved_maps_dir = os.path.join(self.common.root_dir, "savedmaps")
+        # Use the tile textures in the 'textures' folder, if there are any
+        atlas = os.path.join(self.common.root_dir, "textures", "atlas.json")
+        if os.path.exists(atlas):
+            self.common.texture_atlas = atlas
+        # Create graphics handling object (only used to render map images)
+        self.GFX = graphics.Graphics(self.common)
+        # Instance of the map generator
+        self.MapGen = None
+
+
+    def make_maps(self, params, output=None, count=1):
+        """Generates and saves count maps from the generator data params.
+        Each map is saved as <output>.png and a map file, with the seed
+        added to output when making more than one map.  A blank seed gives
+        each map a random seed; otherwise the maps use the given seed with
+        the map number added.
+        """
+        if output is None:
+            if not os.path.exists(self.common.saved_maps_dir):
+                os.mkdir(self.common.saved_maps_dir)
+            output = os.path.join(self.common.saved_maps_dir, "map")
+        for n in range(0, count):
+            map_params = dict(params)
+            if count > 1 and map_params['seed'] is not None:
+                map_params['seed'] = "{0}-{1}".format(map_params['seed'], n)
+            self.make_map(map_params)
+            if count > 1:
+                self.save_map("{0}_{1}".format(output, self.MapGen.params['seed']))
+            else:
+                self.save_map(output)
+
+
+    def make_map(self, params):
+        """Generates a map from the generator data params."""
+        # First map
+        if self.MapGen is None:
+            self.MapGen = genmap.MapGenerator(self.common, params)
+        # Change parameters (if only levels changed, the old noise is reused)
+        else:
+            self.MapGen.set_params(params)
+        self.MapGen.gen_map(self.common.workers)
+
+
+    def save_map(self, path):
+        """Writes the map data to a map file and its image to path.png."""
+        print "Saving \"" + path + "\"..."
+        # Save image to file
+        self.GFX.save_full_map(path + ".png")
+        # Save map data
+        mapfile.save_map(path + mapfile.extensions[self.common.map_format], self.MapGen.params,
+            self.common.tile_map, self.common.map_format)
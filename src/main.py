@@ -3,13 +3,21 @@ import sys
 import os
 import json
 import time
+import argparse
 
 import pygame
 
-from lib import easygui
+try:
+    from lib import easygui
+except ImportError:
+    # No Tk, so only headless mode can be used
+    easygui = None
 import common
 import genmap
 import graphics
+import headless
+import mapfile
+import savejob
 
 
 
@@ -31,6 +39,10 @@ class Main(object):
                 os.mkdir(self.common.saved_maps_dir)
             except Exception:
                 self.EventHandler.FatalExternalError("An error has occurred while trying to create the 'savedmaps' folder.")
+        # Use the tile textures in the 'textures' folder, if there are any
+        atlas = os.path.join(self.common.root_dir, "textures", "atlas.json")
+        if os.path.exists(atlas):
+            self.common.texture_atlas = atlas
 
 
     def start(self):
@@ -76,6 +88,15 @@ class Events(object):
     """Handles some generic actions as well as pygame library events."""
     # Instance of the map generator
     MapGen = None
+    # Direction the map view moves in for each arrow key
+    pan_keys = {
+    pygame.K_LEFT : (-1, 0),
+    pygame.K_RIGHT : (1, 0),
+    pygame.K_UP : (0, -1),
+    pygame.K_DOWN : (0, 1)
+    }
+    # Pixels the map view moves for each arrow key press
+    pan_step = 64
 
 
     def __init__(self, common_inst):
@@ -92,8 +113,10 @@ class Events(object):
         pygame.JOYBUTTONDOWN
         ]
         pygame.event.set_blocked(events_to_block)
-        # flag to be sure we debounce save handler
-        self.currently_saving = False
+        # Repeat held keys, so the map view keeps moving while an arrow key is held
+        pygame.key.set_repeat(300, 30)
+        # Save of the map running in the background (a savejob.SaveJob), None if there is none
+        self.save_job = None
 
 
     def main_menu(self):
@@ -133,8 +156,12 @@ class Events(object):
             # Parts of the prompt window
             info = "These settings can be adjusted later."
             title = "New Map"
+            # Show the default levels in their fields, except the sand level,
+            # which is left blank so it follows the water table
+            defaults = ["", "", ""] + [getattr(genmap.MapGenerator, name) for name in genmap.MapGenerator.level_names]
+            defaults[genmap.MapGenerator.level_names.index("sandlevel") + 3] = ""
             # Get generator parameters
-            params = self.gen_param_prompt(info, title)
+            params = self.gen_param_prompt(info, title, defaults)
             # Return to start if user canceled prompt
             if params is None:
                 return
@@ -146,15 +173,21 @@ class Events(object):
             title = "New Map"
             # Set default field values to current map values
             defaults = [self.MapGen.params['width'], self.MapGen.params['height'], self.MapGen.params['seed']]
+            defaults += [self.MapGen.params[name] for name in genmap.MapGenerator.level_names]
             # Get generation parameters
             params = self.gen_param_prompt(info, title, defaults)
             # Return to start if user canceled prompt
             if params is None:
                 return
-            # Change parameters
+            # Keep settings that are not in the prompt (noise engine, etc.),
+            # a blank sand level follows the water table again
+            for key, value in self.MapGen.params.items():
+                if key != "sandlevel":
+                    params.setdefault(key, value)
+            # Change parameters (if only levels changed, the old noise is reused)
             self.MapGen.set_params(params)
         # Generate map
-        self.MapGen.gen_map()
+        self.MapGen.gen_map(self.common.workers)
         # Tells main to go into the edit phase
         self.common.edit_phase = True
 
@@ -164,9 +197,10 @@ class Events(object):
         them as a dictionary.
         """
         # Add generic info to end of the message displayed in the prompt window
-        msg += "  Leave seed blank for a random seed."
+        msg += "  Leave seed blank for a random seed, and sand level blank to start sand just above the water table."
         # Fields in the prompt
-        fields = ("Width", "Height", "Seed")
+        fields = ("Width", "Height", "Seed", "Water Table", "Sand Level", "Desert Level",
+            "Swamp Level", "Forest Level", "Grassland Level", "Tiaga Level", "Mountain Level")
         # Prompt user for data
         values = easygui.multenterbox(msg, title, fields, defaults)
         # Check if user canceled/closed the prompt
@@ -181,62 +215,75 @@ class Events(object):
         # If seed field was left empty, set seed to none to indicate random seed selection
         if params['seed'] == '':
             params['seed'] = None
+        # Add the tile and biome levels, unless they were left empty
+        for name, value in zip(genmap.MapGenerator.level_names, values[3:]):
+            if value != '':
+                params[name] = float(value)
         return params
 
 
     def load_map(self):
-        """Loads a map from a JSON-formatted file."""
+        """Loads a map from a map file (binary or JSON formatted)."""
         # Prompt user for the map file to open
         map_file = easygui.fileopenbox("Select the map file to open.")
         # Stop and return to start if user canceled/closed the window
         if map_file == None:
             return
-        # Open the file and process the JSON data
-        with open(map_file, 'r') as f:
-            json_data = None
-            try:
-                # Load file's JSON data into python objects
-                json_data = json.loads(f.read())
-                # Load tile map
-                self.common.tile_map = json_data['tile_map']
-                # Create generator with the loaded map's parameters
-                self.MapGen = genmap.MapGenerator(self.common, json_data['generator_data'])
-                # Switch to map edit phase
-                self.common.edit_phase = True
-            # JSON could not load data from the file or it is not correctly formatted
-            except (ValueError, KeyError):
-                # Display info to user
-                msg = "\"{name}\" is not a valid GenEditor JSON formatted map file.".format(
-                    name=os.path.basename(map_file)
-                    )
-                easygui.msgbox(msg, "Invalid Map")
-            finally:
-                # Clear JSON data to save memory
-                del json_data
+        try:
+            # Load the generator data and tile map, whatever the file format is
+            params, self.common.tile_map = mapfile.load_map(map_file)
+            # Create generator with the loaded map's parameters
+            self.MapGen = genmap.MapGenerator(self.common, params)
+            # Switch to map edit phase
+            self.common.edit_phase = True
+        # The file could not be read or it is not correctly formatted
+        except (ValueError, KeyError):
+            # Display info to user
+            msg = "\"{name}\" is not a valid GenEditor map file.".format(
+                name=os.path.basename(map_file)
+                )
+            easygui.msgbox(msg, "Invalid Map")
 
 
     def save_map(self):
-        """Writes the map data to a text file and image file."""
+        """Starts writing the map data to a map file and image file in the
+        background.
+        """
+        # Only one save at a time
+        if self.save_job is not None:
+            easygui.msgbox("The map is still being saved.", "Save In Progress")
+            return
         # Prompt for the save location
-        save_path = easygui.filesavebox("Two files will be created, one image and one text file.")
+        save_path = easygui.filesavebox("Two files will be created, one image and one map file.")
         # User cancels the save operation
         if save_path is None:
             return
-        # Get a complete rendering of the map
-        img = self.GFX.render_full_map()
         # Check if that is already a file(s) with that name(s), and if it ok to override it
         msg = "There is already a file in this location with that name.  Override?"
-        if (os.path.exists(save_path+".bmp") or os.path.exists(save_path+".json")) and easygui.buttonbox(msg, "Continue?", ("Yes", "No")) == "No":
+        map_path = save_path + mapfile.extensions[self.common.map_format]
+        if (os.path.exists(save_path+".png") or os.path.exists(map_path)) and easygui.buttonbox(msg, "Continue?", ("Yes", "No")) == "No":
             return
-        # Otherwise save the map files
+        # Otherwise save the map files, from a copy of the map as it is now
+        else:
+            self.save_job = savejob.SaveJob(self.GFX, save_path, self.MapGen.params,
+                self.common.tile_map, self.common.map_format)
+            self.GFX.show_status("Saving 0%")
+
+
+    def finish_save(self):
+        """Ends the save running in the background once it is done, and
+        tells the user how it went.
+        """
+        job = self.save_job
+        self.save_job = None
+        error = job.finish()
+        self.GFX.show_status()
+        # Indicate saving is complete
+        if error is None:
+            easygui.msgbox("\"" + str(os.path.basename(job.path)) + "\" saved successfully", "Save Complete")
         else:
-            # Save image to file
-            pygame.image.save(img, save_path + ".bmp")
-            # Save map data as JSON data
-            with open(save_path + ".json", 'w') as f:
-                json.dump({'generator_data' : self.MapGen.params, 'tile_map' : self.common.tile_map}, f)
-            # Indicate saving is complete
-            easygui.msgbox("\"" + str(os.path.basename(save_path)) + "\" saved successfully", "Save Complete")
+            easygui.msgbox("\"" + str(os.path.basename(job.path)) + "\" could not be saved: " + str(error), "Save Failed")
+        self.GFX.invalidate()
 
 
     def do_pygame_events(self):
@@ -249,6 +296,18 @@ class Events(object):
                 self.common.edit_phase = False
                 break
 
+            # Display window needs to be drawn again (e.g. was covered by another window)
+            elif event.type in (pygame.VIDEOEXPOSE, pygame.ACTIVEEVENT):
+                self.GFX.invalidate()
+
+            # The save running in the background made progress or finished
+            elif event.type == savejob.save_event:
+                if event.job is self.save_job:
+                    if event.job.done:
+                        self.finish_save()
+                    else:
+                        self.GFX.show_status("Saving {0}%".format(int(event.job.progress*100)))
+
             # Other situations
             else: pass
 
@@ -267,17 +326,31 @@ class Events(object):
             # Opens the main menu
             if event.key == pygame.K_ESCAPE:
                 self.main_menu()
+                # Draw the map again once the menu is closed
+                self.GFX.invalidate()
+
+        # Keyboard press
+        elif event.type == pygame.KEYDOWN:
+            # Arrow keys move the map view
+            if event.key in self.pan_keys:
+                dx, dy = self.pan_keys[event.key]
+                self.GFX.pan(dx*self.pan_step, dy*self.pan_step)
+            # Plus/minus keys zoom in/out at the center of the window
+            elif event.key in (pygame.K_PLUS, pygame.K_EQUALS, pygame.K_KP_PLUS):
+                self.GFX.zoom_at(pygame.display.get_surface().get_rect().center, 1)
+            elif event.key in (pygame.K_MINUS, pygame.K_KP_MINUS):
+                self.GFX.zoom_at(pygame.display.get_surface().get_rect().center, -1)
+            # Save the current map (CTRL+S)
+            elif event.key == pygame.K_s and event.mod & pygame.KMOD_CTRL:
+                self.save_map()
 
-        # Get the current keyboard key states
-        key_states = pygame.key.get_pressed()
+        # Mouse wheel zooms in/out at the mouse pointer
+        elif event.type == pygame.MOUSEBUTTONDOWN and event.button in (4, 5):
+            self.GFX.zoom_at(event.pos, 1 if event.button == 4 else -1)
 
-        # Save the current map (CTRL+S)
-        # self.currently_saving is used to debounce the save handler.
-        if key_states[pygame.K_s] and (key_states[pygame.K_LCTRL] or key_states[pygame.K_RCTRL]):
-            if not self.currently_saving:
-                self.currently_saving = True
-                self.save_map()
-                self.currently_saving = False
+        # Dragging with the left or right mouse button moves the map view
+        elif event.type == pygame.MOUSEMOTION and (event.buttons[0] or event.buttons[2]):
+            self.GFX.pan(-event.rel[0], -event.rel[1])
 
 
     def update_display(self):
@@ -306,11 +379,76 @@ class Events(object):
 
     def quit(self):
         """Does any cleanup operations then terminates the program."""
+        # Let a save running in the background finish first
+        if self.save_job is not None:
+            self.GFX.show_status("Finishing save...")
+            self.save_job.finish()
         # Terminate pygame functions
         pygame.quit()
         sys.exit()
 
 
 
-M = Main()
-M.start()
+if __name__ == "__main__":
+    # Read command line options
+    parser = argparse.ArgumentParser(description="GenEditor for Tile Maps")
+    parser.add_argument("--workers", type=int, default=1,
+        help="number of worker processes used to generate maps (default: 1)")
+    parser.add_argument("--tile-size", type=int, default=90,
+        help="size of the tiles in saved map images, in pixels (default: 90)")
+    parser.add_argument("--format", choices=sorted(mapfile.extensions), default="binary",
+        help="format of saved map files (default: binary)")
+    parser.add_argument("--textures", metavar="ATLAS",
+        help="JSON file describing a tile texture atlas (default: textures/atlas.json, if it exists)")
+    # Options of headless mode
+    parser.add_argument("--headless", action="store_true",
+        help="generate, render and save maps without a window or dialogs")
+    parser.add_argument("--width", type=int, help="map width in tiles (headless, default: 100)")
+    parser.add_argument("--height", type=int, help="map height in tiles (headless, default: 100)")
+    parser.add_argument("--seed", help="map seed (headless, default: random)")
+    parser.add_argument("--params", metavar="FILE",
+        help="saved map, or JSON file of generator data, to make maps like (headless)")
+    parser.add_argument("--set", metavar="NAME=VALUE", action="append", default=[],
+        help="set a generator data value, e.g. --set engine=simplex (headless, can be repeated)")
+    parser.add_argument("--count", type=int, default=1,
+        help="number of maps to make, each with its own seed (headless, default: 1)")
+    parser.add_argument("--output", metavar="PATH",
+        help="where to save the map files, without extension (headless, default: savedmaps/map)")
+    args = parser.parse_args()
+    if args.headless:
+        # Generator data from the file, then the options
+        params = {}
+        if args.params is not None:
+            params = mapfile.load_generator_data(args.params)
+        for name, value in (('width', args.width), ('height', args.height), ('seed', args.seed)):
+            if value is not None:
+                params[name] = value
+        params.setdefault('width', 100)
+        params.setdefault('height', 100)
+        params.setdefault('seed', None)
+        for setting in args.set:
+            if "=" not in setting:
+                parser.error("--set values must be NAME=VALUE, got '{0}'".format(setting))
+            name, value = setting.split("=", 1)
+            # Values are JSON (numbers, true/false), anything else is a string
+            try:
+                params[name] = json.loads(value)
+            except ValueError:
+                params[name] = value
+        H = headless.Headless()
+        H.common.workers = args.workers
+        H.common.image_tile_size = args.tile_size
+        H.common.map_format = args.format
+        if args.textures is not None:
+            H.common.texture_atlas = args.textures
+        H.make_maps(params, args.output, args.count)
+    else:
+        if easygui is None:
+            parser.error("Tkinter is not available, only --headless can be used")
+        M = Main()
+        M.common.workers = args.workers
+        M.common.image_tile_size = args.tile_size
+        M.common.map_format = args.format
+        if args.textures is not None:
+            M.common.texture_atlas = args.textures
+        M.start()
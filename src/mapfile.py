@@ -0,0 +1,976 @@
+#!/usr/bin/python
+"""Reads and writes saved map files.  Maps are saved in a binary format:
+
+    magic bytes   "\\x89GenMap\\n"
+    header size   4 byte unsigned integer (big endian)
+    header        JSON object with the map's width, height, palette (tile
+                  names by tile ID) and generator_data
+    tiles         zlib compressed tile IDs, one byte per tile, row by row
+
+Maps saved in the "mapped" format have the same header, with "compression"
+set to "none", and their tile IDs uncompressed, starting at the next multiple
+of 64KB in the file.  Their tiles are memory mapped instead of read (see
+MappedTiles), so even huge maps open instantly and only the parts of the
+map that are used (and the edited rows) take up memory.
+
+Maps saved in the "chunked" format (for very large worlds) have the same
+header, with "compression" set to "chunks", padded with spaces to leave room
+for it to grow.  The map is split into chunks of chunk_size by chunk_size
+tiles (smaller at the right and bottom edges), each compressed on its own:
+
+    chunk table   offset (8 bytes) and size (4 bytes) of each chunk, row by
+                  row (big endian), offset and size 0 for chunks of only
+                  tile ID 0
+    chunks        zlib compressed tile IDs of each chunk, row by row
+
+Only the header and chunk table are read when the map is loaded, chunks are
+read when their tiles are first used and only the recently used ones are
+kept in memory (see ChunkedTiles).  Saving a map to the chunked file it was
+loaded from only adds the changed chunks to the end of the file.
+
+Maps saved as JSON by older versions ({"generator_data": {...},
+"tile_map": [[tile names]]}) can still be loaded.
+"""
+import collections
+import json
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+import tilemap
+
+
+# Bytes every binary map file starts with
+magic = "\x89GenMap\n"
+# File extension of each map file format
+extensions = {"binary": ".map", "mapped": ".map", "chunked": ".map", "json": ".json"}
+# Tiles of mapped map files start at a multiple of this, which is a valid
+# memory map offset on every system
+mapped_alignment = 1 << 16
+# Width and height of the chunks of chunked map files, in tiles
+chunk_size = 64
+# Format of each entry of the chunk table of chunked map files
+chunk_entry = struct.Struct(">QI")
+
+
+
+def save_map(path, params, tile_map, file_format="binary"):
+    """Writes a map and its generator data to a file, in the given format
+    ("binary", "mapped", "chunked" or "json").  The map is written to a
+    temporary file first, which then replaces the old file, so the old file
+    stays intact if saving fails.  A map loaded from a chunked file is saved
+    to that file by only writing its changed chunks.  Windows can not
+    replace a file that is open, so there a map read from the file it is
+    saved to stops reading it while it is replaced, and can only replace
+    it with a file of the same format (which it then reads instead).
+    """
+    savers = {"binary": save_binary_map, "mapped": save_mapped_map,
+        "chunked": save_chunked_map, "json": save_json_map}
+    if file_format not in savers:
+        raise ValueError("Unknown map file format: " + str(file_format))
+    if file_format == "chunked" and update_chunked_map(path, params, tile_map):
+        tile_map.data.written = True
+        return
+    temp_path = path + ".tmp"
+    data = tile_map.data
+    # The file the tiles are read from, if they are replacing it on Windows
+    tile_file = None
+    if os.name == "nt" and isinstance(data, LazyTiles) and data.source.path == os.path.abspath(path):
+        tile_file = data.source
+        if file_format != data.file_format:
+            raise IOError("A map can not replace the file it is read from with a file of another format on Windows")
+    try:
+        savers[file_format](temp_path, params, tile_map)
+        if tile_file is not None:
+            tile_file.replace(temp_path, path)
+        else:
+            replace_file(temp_path, path)
+    except:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    # Read the chunks not loaded yet from the new file
+    if file_format == "chunked" and isinstance(data, ChunkedTiles):
+        if tile_file is None:
+            data.source.open(path)
+        for n in list(data.changed):
+            data.chunks[n] = data.changed.pop(n)
+        data.drop_chunks()
+        data.written = True
+
+
+def replace_file(source, destination):
+    """Renames source to destination, replacing destination if it exists.
+    Windows can not rename onto an existing file, so there the old file is
+    removed first.
+    """
+    if os.name == "nt" and os.path.exists(destination):
+        os.remove(destination)
+    os.rename(source, destination)
+
+
+def save_binary_map(path, params, tile_map):
+    """Writes a map and its generator data to a binary map file."""
+    with open(path, 'wb') as f:
+        write_binary_header(f, binary_header(params, tile_map))
+        compressor = zlib.compressobj(6)
+        for tiles in tile_bands(tile_map):
+            f.write(compressor.compress(tiles))
+        f.write(compressor.flush())
+
+
+def save_mapped_map(path, params, tile_map):
+    """Writes a map and its generator data to a mapped map file, a binary
+    map file with uncompressed tiles at a fixed place.
+    """
+    with open(path, 'wb') as f:
+        write_binary_header(f, binary_header(params, tile_map, compression="none"))
+        # Pad up to the start of the tiles
+        f.write("\0"*(mapped_offset(f.tell()) - f.tell()))
+        for tiles in tile_bands(tile_map):
+            f.write(tiles)
+
+
+def save_chunked_map(path, params, tile_map):
+    """Writes a map and its generator data to a chunked map file.  Chunks
+    that have not changed since the map was loaded from a chunked file are
+    copied from that file without decompressing them.
+    """
+    data = tile_map.data
+    source = None
+    if isinstance(data, ChunkedTiles) and data.chunk_size == chunk_size:
+        source = data.source
+    columns, rows = -(-tile_map.width//chunk_size), -(-tile_map.height//chunk_size)
+    with open(path, 'wb') as f:
+        header = binary_header(params, tile_map, compression="chunks", chunk_size=chunk_size)
+        write_binary_header(f, header.ljust(header_space(header)))
+        # Leave room for the chunk table, written once the chunks are
+        table_offset = f.tell()
+        f.write("\0"*(chunk_entry.size*columns*rows))
+        table = bytearray(chunk_entry.size*columns*rows)
+        for n in range(0, columns*rows):
+            if source is not None and n not in data.changed:
+                chunk = source.read_chunk(n)
+            else:
+                chunk = compress_chunk(area_tiles(data, tile_map.width, *chunk_area(n, chunk_size, tile_map.width, tile_map.height)))
+            chunk_entry.pack_into(table, chunk_entry.size*n, f.tell() if chunk else 0, len(chunk))
+            f.write(chunk)
+        f.seek(table_offset)
+        f.write(table)
+
+
+def update_chunked_map(path, params, tile_map):
+    """Writes only the changed chunks of a map loaded from the chunked map
+    file at path to the end of that file, then updates its chunk table and
+    header (if it changed) in place.  Unlike other saves this is not atomic:
+    a crash while the table or header is written can damage the file.
+    Returns False (without changing the file) if the map was not
+    loaded from that file, the header no longer fits or the file would be
+    mostly unused space.
+    """
+    data = tile_map.data
+    if not isinstance(data, ChunkedTiles) or data.source.path != os.path.abspath(path):
+        return False
+    source = data.source
+    header = binary_header(params, tile_map, compression="chunks", chunk_size=data.chunk_size)
+    if len(header) > source.header_size:
+        return False
+    changed = [(n, compress_chunk(str(data.changed[n]))) for n in sorted(data.changed)]
+    with open(path, 'r+b') as f:
+        # The file may have been replaced since the map was loaded from it
+        if not same_file(f, source.file) or f.read(len(magic)) != magic or read_binary_header(f) != source.header:
+            return False
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+        # Write the whole file again once it is more than half old chunks
+        added = sum([len(chunk) for n, chunk in changed])
+        used = source.stored_size() + added - sum([source.entry(n)[1] for n, chunk in changed])
+        if 2*used + source.table_end < end + added:
+            return False
+        table = bytearray(source.table)
+        for n, chunk in changed:
+            chunk_entry.pack_into(table, chunk_entry.size*n, f.tell() if chunk else 0, len(chunk))
+            f.write(chunk)
+        # The new chunks must be in the file before the table points to them
+        f.flush()
+        os.fsync(f.fileno())
+        for n, chunk in changed:
+            f.seek(source.table_end - len(table) + chunk_entry.size*n)
+            f.write(table[chunk_entry.size*n:chunk_entry.size*(n+1)])
+        f.flush()
+        os.fsync(f.fileno())
+        if json.loads(header) != source.header:
+            f.seek(len(magic) + 4)
+            f.write(header.ljust(source.header_size))
+            f.flush()
+            os.fsync(f.fileno())
+    # Only chunks the tiles (and their copies) changed point elsewhere now
+    with source.lock:
+        source.table = table
+        source.used = used
+        source.header = json.loads(header)
+    for n, chunk in changed:
+        data.chunks[n] = data.changed.pop(n)
+    data.drop_chunks()
+    return True
+
+
+def same_file(a, b):
+    """Returns whether two open files are the same file.  Files can not be
+    told apart this way on Windows, where it always returns True (so their
+    headers should be compared too).
+    """
+    stat_a, stat_b = os.fstat(a.fileno()), os.fstat(b.fileno())
+    return (stat_a.st_dev, stat_a.st_ino) == (stat_b.st_dev, stat_b.st_ino)
+
+
+def binary_header(params, tile_map, **fields):
+    """Returns the JSON header of a binary map file, with any extra header
+    fields given.
+    """
+    fields.update({
+    'width' : tile_map.width,
+    'height' : tile_map.height,
+    'palette' : tile_map.palette,
+    'generator_data' : params
+    })
+    return json.dumps(fields)
+
+
+def write_binary_header(f, header):
+    """Writes the magic bytes and a header to a binary map file."""
+    f.write(magic)
+    f.write(struct.pack(">I", len(header)))
+    f.write(header)
+
+
+def header_space(header):
+    """Returns the size of the space for the header of a chunked map file,
+    leaving room for the header to grow.
+    """
+    return -(-(len(header) + 1024)//4096)*4096
+
+
+def mapped_offset(position):
+    """Returns where the tiles of a mapped map file start, given where its
+    header ends.
+    """
+    return -(-position // mapped_alignment)*mapped_alignment
+
+
+def chunk_area(n, size, width, height):
+    """Returns the area (left, top, right, bottom) of tiles of chunk n of a
+    map with chunks of size by size tiles, right and bottom not included.
+    """
+    columns = -(-width//size)
+    left, top = (n % columns)*size, (n // columns)*size
+    return left, top, min(left + size, width), min(top + size, height)
+
+
+def tile_bands(tile_map, size=1 << 20):
+    """Yields the tile IDs of a tile map as strings of about size bytes, a
+    band of rows at a time.
+    """
+    rows = max(1, size//max(tile_map.width, 1))
+    for top in range(0, tile_map.height, rows):
+        yield str(tile_map.data[top*tile_map.width:min(top + rows, tile_map.height)*tile_map.width])
+
+
+def area_tiles(data, width, left, top, right, bottom):
+    """Returns the tile IDs of an area of tiles as a string, row by row."""
+    return "".join([str(data[y*width + left:y*width + right]) for y in range(top, bottom)])
+
+
+def compress_chunk(tiles):
+    """Compresses the tile IDs of a chunk, or returns "" if they are all 0."""
+    if not tiles.strip("\0"):
+        return ""
+    return zlib.compress(tiles, 6)
+
+
+def save_json_map(path, params, tile_map):
+    """Writes a map and its generator data to a JSON map file (the format
+    of older versions).
+    """
+    with open(path, 'w') as f:
+        json.dump({'generator_data' : params, 'tile_map' : tile_map.to_lists()}, f)
+
+
+def load_map(path):
+    """Reads a map file of any format.  Returns the generator data and the
+    tile map (a tilemap.TileMap).  Raises ValueError or KeyError if the file
+    is not a valid map file.
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(magic)) == magic:
+            try:
+                return read_binary_map(f)
+            except (mmap.error, MemoryError) as error:
+                raise ValueError("Map file can not be loaded: " + str(error))
+        f.seek(0)
+        return read_json_map(f)
+
+
+def load_generator_data(path):
+    """Reads only the generator data of a map file of any format.  A JSON
+    file of just generator data is read as is.
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(magic)) == magic:
+            return read_binary_header(f)['generator_data']
+        f.seek(0)
+        json_data = json.load(f)
+        return json_data.get('generator_data', json_data)
+
+
+def read_binary_header(f):
+    """Reads the header of a binary map file, after its magic bytes."""
+    try:
+        header_size, = struct.unpack(">I", f.read(4))
+    except struct.error as error:
+        raise ValueError("Damaged map file: " + str(error))
+    return json.loads(f.read(header_size))
+
+
+def read_binary_map(f):
+    """Reads the rest of a binary map file, after its magic bytes.  The
+    tiles of mapped and chunked map files are not read here (see
+    MappedTiles and ChunkedTiles), so they are not checked against the
+    palette.
+    """
+    header = read_binary_header(f)
+    width, height = header['width'], header['height']
+    compression = header.get('compression', "zlib")
+    if compression == "none":
+        data = map_tiles(f, width, height)
+    elif compression == "chunks":
+        data = bytearray()
+        if width*height > 0:
+            data = ChunkedTiles(width, height, header['chunk_size'])
+            data.source.open(f.name)
+    else:
+        try:
+            data = bytearray(zlib.decompress(f.read()))
+        except zlib.error as error:
+            raise ValueError("Damaged map file: " + str(error))
+        if len(data) != width*height:
+            raise ValueError("Map file has {0} tiles, expected {1}".format(len(data), width*height))
+        # Every tile ID must be in the palette
+        if len(header['palette']) < 256 and data.translate(None, str(bytearray(range(0, len(header['palette']))))):
+            raise ValueError("Map file has tile IDs that are not in its palette")
+    return header['generator_data'], tilemap.TileMap(width, height, header['palette'], data)
+
+
+def map_tiles(f, width, height):
+    """Memory maps the tiles of a mapped map file, after its header.
+    Changes to the tiles are only made in memory, never to the file.
+    """
+    # Empty files can not be memory mapped
+    if width*height == 0:
+        return bytearray()
+    source = MappedFile(width, height)
+    source.map_file(f)
+    return MappedTiles(source, width, height)
+
+
+def read_json_map(f):
+    """Reads a JSON map file a piece at a time.  The rows of the tile map are
+    turned into tile IDs one at a time, so neither the whole text of the
+    file nor the tile map as lists of names is ever in memory.
+    """
+    reader = JSONReader(f)
+    generator_data = None
+    tile_map = None
+    reader.expect("{")
+    if reader.peek() == "}":
+        raise KeyError("generator_data")
+    while True:
+        key = reader.value()
+        reader.expect(":")
+        if key == "tile_map":
+            tile_map = read_json_tiles(reader)
+        elif key == "generator_data":
+            generator_data = reader.value()
+        else:
+            reader.value()
+        if reader.expect(",}") == "}":
+            break
+    if generator_data is None:
+        raise KeyError("generator_data")
+    if tile_map is None:
+        raise KeyError("tile_map")
+    return generator_data, tile_map
+
+
+def read_json_tiles(reader):
+    """Reads the tile map of a JSON map file, a list of rows of tile names,
+    one row at a time.
+    """
+    palette = list(tilemap.TileMap.default_palette)
+    ids = dict((name, n) for n, name in enumerate(palette))
+    data = bytearray()
+    width = None
+    height = 0
+    reader.expect("[")
+    if reader.peek() == "]":
+        reader.expect("]")
+        return tilemap.TileMap(0, 0)
+    while True:
+        row = reader.value()
+        if not isinstance(row, list) or (width is not None and len(row) != width):
+            raise ValueError("Tile map rows must be lists of the same length")
+        if not all(isinstance(name, basestring) for name in row):
+            raise ValueError("Tile names must be strings")
+        width = len(row)
+        # Add new tile names to the palette, in the order they first appear
+        for name in sorted(set(row).difference(ids), key=row.index):
+            if len(palette) >= 256:
+                raise ValueError("A tile map can not have more than 256 tile types")
+            ids[name] = len(palette)
+            palette.append(name)
+        data.extend(bytearray([ids[name] for name in row]))
+        height += 1
+        if reader.expect(",]") == "]":
+            break
+    return tilemap.TileMap(width, height, palette, data)
+
+
+
+class LazyTiles(object):
+    """Tile IDs that are read from a map file as they are used, instead of
+    all at once.  Works like the bytearray of tile IDs of a
+    tilemap.TileMap: tiles are integers and slices are bytearrays.
+    Subclasses read and change runs of tiles within one row (get_run() and
+    set_run()).
+    """
+    def __init__(self, width, height):
+        # Dimensions in tiles
+        self.width = width
+        self.height = height
+
+
+    def get_run(self, y, left, right):
+        """Returns a bytearray of the tile IDs of row y from left to right
+        (not included).
+        """
+        raise NotImplementedError
+
+
+    def set_run(self, y, left, tiles):
+        """Sets tile IDs of row y, from left on, to a bytearray."""
+        raise NotImplementedError
+
+
+    def get_range(self, start, end):
+        """Returns a bytearray of the tile IDs from index start to end (not
+        included).
+        """
+        tiles = bytearray()
+        while start < end:
+            y, x = divmod(start, self.width)
+            right = min(self.width, x + end - start)
+            tiles += self.get_run(y, x, right)
+            start += right - x
+        return tiles
+
+
+    def set_range(self, start, tiles):
+        """Sets the tile IDs from index start on to a bytearray."""
+        done = 0
+        while done < len(tiles):
+            y, x = divmod(start + done, self.width)
+            right = min(self.width, x + len(tiles) - done)
+            self.set_run(y, x, tiles[done:done + right - x])
+            done += right - x
+
+
+    def tile_index(self, index):
+        """Returns a tile index, counting negative indexes from the end."""
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("Tile index out of range")
+        return index
+
+
+    def __len__(self):
+        """Returns the number of tiles."""
+        return self.width*self.height
+
+
+    def __getitem__(self, index):
+        """Returns a tile ID, or a bytearray of the tile IDs in a slice."""
+        if not isinstance(index, slice):
+            y, x = divmod(self.tile_index(index), self.width)
+            return self.get_run(y, x, x+1)[0]
+        start, end, step = index.indices(len(self))
+        positions = xrange(start, end, step)
+        if not positions:
+            return bytearray()
+        low = min(positions[0], positions[-1])
+        tiles = self.get_range(low, max(positions[0], positions[-1]) + 1)
+        if step == 1:
+            return tiles
+        return tiles[positions[0] - low::step]
+
+
+    def __getslice__(self, start, end):
+        """Returns a bytearray of the tile IDs from start to end."""
+        return self.__getitem__(slice(start, end))
+
+
+    def __setitem__(self, index, value):
+        """Sets a tile ID, or the tile IDs in a slice to a bytearray of the
+        same length.
+        """
+        if not isinstance(index, slice):
+            self.set_range(self.tile_index(index), bytearray([value]))
+            return
+        start, end, step = index.indices(len(self))
+        if step != 1 or len(value) != max(0, end - start):
+            raise ValueError("Tile slices can only be set to as many tiles as they have")
+        self.set_range(start, bytearray(value))
+
+
+    def __setslice__(self, start, end, value):
+        """Sets the tile IDs from start to end to a bytearray."""
+        self.__setitem__(slice(start, end), value)
+
+
+    def __iter__(self):
+        """Iterates over the tile IDs, row by row."""
+        for y in xrange(0, self.height):
+            for tile in self.get_run(y, 0, self.width):
+                yield tile
+
+
+
+class MappedTiles(LazyTiles):
+    """Tile IDs memory mapped (read only) from a file.  Parts of the file
+    are only read when they are used.  Rows of tiles are copied to memory
+    when they are first changed, so the file never changes and unchanged
+    rows never count against the memory the system can commit.
+    """
+    # Format of the map file the tiles are read from
+    file_format = "mapped"
+
+
+    def __init__(self, source, width, height):
+        LazyTiles.__init__(self, width, height)
+        # Mapped map file the tile IDs are read from (a MappedFile)
+        self.source = source
+        # Tile IDs of the changed rows, by row number
+        self.rows = {}
+
+
+    def copy(self):
+        """Returns a copy of the tiles, with copies of the changed rows, that
+        reads the other rows from the same file.
+        """
+        tiles = MappedTiles(self.source, self.width, self.height)
+        tiles.rows = dict((y, bytearray(row)) for y, row in self.rows.items())
+        return tiles
+
+
+    def get_run(self, y, left, right):
+        """Returns a bytearray of the tile IDs of row y from left to right
+        (not included).
+        """
+        if y in self.rows:
+            return self.rows[y][left:right]
+        return self.source.read(y*self.width + left, y*self.width + right)
+
+
+    def set_run(self, y, left, tiles):
+        """Sets tile IDs of row y, from left on, to a bytearray."""
+        if y not in self.rows:
+            self.rows[y] = self.source.read(y*self.width, (y+1)*self.width)
+        self.rows[y][left:left + len(tiles)] = tiles
+
+
+
+class ChunkedTiles(LazyTiles):
+    """Tile IDs of a chunked map file, which are read and decompressed a
+    chunk at a time when they are first used.  Chunks that have not changed
+    are kept in a cache of the most recently used ones, so a map can be much
+    larger than memory.  Changed chunks are kept until they are saved, so
+    saving only has to write them.
+    """
+    # Format of the map file the tiles are read from
+    file_format = "chunked"
+    # Most unchanged chunks kept in memory (at least two rows of chunks)
+    cache_size = 1 << 14
+
+
+    def __init__(self, width, height, chunk_size):
+        LazyTiles.__init__(self, width, height)
+        # Width and height of the chunks, in tiles
+        self.chunk_size = chunk_size
+        # Number of chunks in each row of chunks, and in all
+        self.columns = -(-width//chunk_size)
+        self.count = self.columns*-(-height//chunk_size)
+        # Tile IDs of the loaded chunks that have not changed, by chunk
+        # number, least recently used first
+        self.chunks = collections.OrderedDict()
+        # Tile IDs of the chunks changed since they were saved, by chunk number
+        self.changed = {}
+        # Changed chunks being saved from a copy of these tiles (see copy())
+        self.saving = set()
+        # Chunked map file the chunks are read from (see ChunkFile.open())
+        self.source = ChunkFile(width, height, chunk_size)
+        # Whether save_map() wrote these tiles to a chunked map file (the one of source)
+        self.written = False
+
+
+    def copy(self):
+        """Returns a copy of the tiles, with copies of the changed chunks,
+        that reads the other chunks from the same file.  saved() must be
+        called once the copy has been saved (or failed to).
+        """
+        tiles = ChunkedTiles(self.width, self.height, self.chunk_size)
+        tiles.source = self.source
+        tiles.changed = dict((n, bytearray(chunk)) for n, chunk in self.changed.items())
+        self.saving = set(self.changed)
+        return tiles
+
+
+    def saved(self, tiles):
+        """Forgets the changes to chunks saved with a copy of these tiles
+        (see copy()) and not changed since, if the copy was saved to a
+        chunked map file (which both read their chunks from since).
+        """
+        if tiles.written:
+            for n in self.saving:
+                self.chunks[n] = self.changed.pop(n)
+            self.drop_chunks()
+        self.saving = set()
+
+
+    def chunk_area(self, n):
+        """Returns the area (left, top, right, bottom) of tiles of chunk n,
+        right and bottom not included.
+        """
+        return chunk_area(n, self.chunk_size, self.width, self.height)
+
+
+    def load_chunk(self, n):
+        """Reads and decompresses the tile IDs of chunk n."""
+        left, top, right, bottom = self.chunk_area(n)
+        chunk = self.source.read_chunk(n)
+        if not chunk:
+            return bytearray((right-left)*(bottom-top))
+        try:
+            tiles = bytearray(zlib.decompress(chunk))
+        except zlib.error as error:
+            raise ValueError("Damaged map file: " + str(error))
+        if len(tiles) != (right-left)*(bottom-top):
+            raise ValueError("Map file chunk has {0} tiles, expected {1}".format(len(tiles), (right-left)*(bottom-top)))
+        return tiles
+
+
+    def chunk(self, n):
+        """Returns the tile IDs of chunk n (a bytearray, row by row), loading
+        the chunk if needed.
+        """
+        if n in self.changed:
+            return self.changed[n]
+        tiles = self.chunks.pop(n, None)
+        if tiles is None:
+            tiles = self.load_chunk(n)
+        self.chunks[n] = tiles
+        self.drop_chunks()
+        return tiles
+
+
+    def change_chunk(self, n):
+        """Returns the tile IDs of chunk n to change them."""
+        if n not in self.changed:
+            self.changed[n] = self.chunk(n)
+            del self.chunks[n]
+        self.saving.discard(n)
+        return self.changed[n]
+
+
+    def drop_chunks(self):
+        """Drops the least recently used unchanged chunks over the cache size."""
+        while len(self.chunks) > max(self.cache_size, 2*self.columns):
+            self.chunks.popitem(False)
+
+
+    def get_run(self, y, left, right):
+        """Returns a bytearray of the tile IDs of row y from left to right
+        (not included).
+        """
+        row, tiles = y//self.chunk_size, bytearray()
+        while left < right:
+            column = left//self.chunk_size
+            chunk_left = column*self.chunk_size
+            chunk_width = min(self.chunk_size, self.width - chunk_left)
+            end = min(right, chunk_left + chunk_width)
+            start = (y - row*self.chunk_size)*chunk_width - chunk_left
+            tiles += self.chunk(row*self.columns + column)[start + left:start + end]
+            left = end
+        return tiles
+
+
+    def set_run(self, y, left, tiles):
+        """Sets tile IDs of row y, from left on, to a bytearray."""
+        row, done = y//self.chunk_size, 0
+        while done < len(tiles):
+            column = (left + done)//self.chunk_size
+            chunk_left = column*self.chunk_size
+            chunk_width = min(self.chunk_size, self.width - chunk_left)
+            end = min(left + len(tiles), chunk_left + chunk_width)
+            start = (y - row*self.chunk_size)*chunk_width - chunk_left
+            self.change_chunk(row*self.columns + column)[start + left + done:start + end] = tiles[done:end - left]
+            done = end - left
+
+
+
+class TileFile(object):
+    """An open map file that tiles are read from as they are used (see
+    LazyTiles).  Copies of the tiles share it, so switching it to another
+    file (see open()) switches them all.
+    """
+    def __init__(self):
+        # Absolute path of the file
+        self.path = None
+        # Keeps reads from the file and switching files apart
+        self.lock = threading.RLock()
+
+
+    def open(self, path):
+        """Reads tiles from the map file at path from now on, and closes
+        the old file.
+        """
+        raise NotImplementedError
+
+
+    def close(self):
+        """Closes the file."""
+        raise NotImplementedError
+
+
+    def replace(self, source, path):
+        """Replaces the file at path, which is this file, with the file at
+        source (see replace_file()), and reads tiles from it from now on.
+        The file is closed while it is replaced, since Windows can not
+        replace open files.
+        """
+        with self.lock:
+            self.close()
+            try:
+                replace_file(source, path)
+            finally:
+                self.open(path)
+
+
+
+class MappedFile(TileFile):
+    """A mapped map file that MappedTiles read tiles from, memory mapped
+    read only.
+    """
+    def __init__(self, width, height):
+        TileFile.__init__(self)
+        # Dimensions of the map, which the file must match
+        self.width = width
+        self.height = height
+        # Memory map of the tile IDs in the file
+        self.map = None
+
+
+    def open(self, path):
+        """Reads tiles from the mapped map file at path from now on, and
+        closes the old file.
+        """
+        with open(path, 'rb') as f:
+            if f.read(len(magic)) != magic:
+                raise ValueError("Not a binary map file")
+            header = read_binary_header(f)
+            if (header['width'], header['height'], header.get('compression')) != (self.width, self.height, "none"):
+                raise ValueError("Map file is not a mapped map file of the same size as the map")
+            self.map_file(f)
+
+
+    def map_file(self, f):
+        """Memory maps the tiles of the mapped map file f, after its
+        header, reading tiles from them from now on.
+        """
+        offset, size = mapped_offset(f.tell()), self.width*self.height
+        f.seek(0, os.SEEK_END)
+        if f.tell() < offset + size:
+            raise ValueError("Map file has {0} tiles, expected {1}".format(max(f.tell() - offset, 0), size))
+        tiles = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ, offset=offset)
+        with self.lock:
+            self.close()
+            self.map = tiles
+            self.path = os.path.abspath(f.name)
+
+
+    def close(self):
+        """Closes the memory map."""
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+
+    def read(self, start, end):
+        """Returns a bytearray of the tile IDs from index start to end (not
+        included).
+        """
+        with self.lock:
+            return bytearray(self.map[start:end])
+
+
+
+class ChunkFile(TileFile):
+    """A chunked map file that ChunkedTiles read chunks from, with its
+    header and chunk table.
+    """
+    def __init__(self, width, height, chunk_size):
+        TileFile.__init__(self)
+        # Dimensions of the map and of its chunks, which the file must match
+        self.width = width
+        self.height = height
+        self.chunk_size = chunk_size
+        # Number of chunks
+        self.count = -(-width//chunk_size)*-(-height//chunk_size)
+        # The open file
+        self.file = None
+        # Header of the file, the size of the space for it, and where the chunk table ends
+        self.header = None
+        self.header_size = 0
+        self.table_end = 0
+        # Offset and size of each chunk in the file (packed chunk table
+        # entries, see entry()), and the total size of the chunks (None
+        # until needed, see stored_size())
+        self.table = bytearray()
+        self.used = None
+
+
+    def open(self, path):
+        """Reads chunks from the chunked map file at path from now on,
+        reading its chunk table, and closes the old file.
+        """
+        f = open(path, 'rb')
+        try:
+            if f.read(len(magic)) != magic:
+                raise ValueError("Not a binary map file")
+            header = read_binary_header(f)
+            if (header['width'], header['height'], header.get('chunk_size')) != (self.width, self.height, self.chunk_size):
+                raise ValueError("Map file does not have the same size or chunks as the map")
+            header_size = f.tell() - len(magic) - 4
+            table = f.read(chunk_entry.size*self.count)
+            if len(table) != chunk_entry.size*self.count:
+                raise ValueError("Damaged map file: the chunk table is incomplete")
+        except:
+            f.close()
+            raise
+        with self.lock:
+            self.close()
+            self.file = f
+            self.path = os.path.abspath(path)
+            self.header = header
+            self.header_size = header_size
+            self.table = bytearray(table)
+            self.used = None
+            self.table_end = f.tell()
+
+
+    def close(self):
+        """Closes the file."""
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+    def entry(self, n):
+        """Returns the offset and size of chunk n in the file."""
+        return chunk_entry.unpack_from(self.table, chunk_entry.size*n)
+
+
+    def stored_size(self):
+        """Returns the total size of the chunks in the file."""
+        if self.used is None:
+            self.used = sum([self.entry(n)[1] for n in xrange(0, self.count)])
+        return self.used
+
+
+    def read_chunk(self, n):
+        """Returns the compressed tile IDs of chunk n in the file (an empty
+        string for chunks of only tile ID 0).
+        """
+        with self.lock:
+            offset, size = self.entry(n)
+            self.file.seek(offset)
+            return self.file.read(size)
+
+
+
+class JSONReader(object):
+    """Reads JSON text from a file in pieces, one value at a time."""
+    # Number of characters read from the file at a time
+    chunk_size = 1 << 16
+
+
+    def __init__(self, f):
+        # File the JSON text is read from
+        self.file = f
+        # Text read from the file but not parsed yet, starting at position
+        self.text = ""
+        self.position = 0
+        # Parses values from the text
+        self.decoder = json.JSONDecoder()
+
+
+    def read_more(self):
+        """Reads the next piece of the file, returns False at the end of it."""
+        data = self.file.read(self.chunk_size)
+        if not data:
+            return False
+        # Drop the text already parsed
+        self.text = self.text[self.position:] + data
+        self.position = 0
+        return True
+
+
+    def peek(self):
+        """Returns the next character that is not whitespace (without using
+        it up), or "" at the end of the file.
+        """
+        while True:
+            while self.position < len(self.text) and self.text[self.position] in " \t\r\n":
+                self.position += 1
+            if self.position < len(self.text) or not self.read_more():
+                return self.text[self.position:self.position+1]
+
+
+    def expect(self, characters):
+        """Uses up the next character that is not whitespace and returns it.
+        Raises ValueError if it is not one of the given characters.
+        """
+        character = self.peek()
+        if character == "" or character not in characters:
+            raise ValueError("Expected one of '{0}' in JSON map file".format(characters))
+        self.position += 1
+        return character
+
+
+    def value(self):
+        """Parses and returns the next JSON value."""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.text, self.position)
+                # A number may go on in the next piece of the file
+                if end < len(self.text) or not self.text[self.position] in "-0123456789":
+                    self.position = end
+                    return value
+            except ValueError:
+                pass
+            # The value may not be complete yet
+            if not self.read_more():
+                value, self.position = self.decoder.raw_decode(self.text, self.position)
+                return value
@@ -0,0 +1,563 @@
+#!/usr/bin/python
+"""Noise engines used by the map generator.
+
+Credit goes to Ryan (1egoman) for the majority of the value noise code
+below, which turbulence_grid() is based on.
+"""
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def lattice_hash(key, x, y):
+    """Hashes a pair of integer lattice coordinates to a 32 bit value.  Works
+    the same on Python integers and NumPy integer arrays, so both noise
+    backends give identical world maps.
+    """
+    h = (key + x*374761393 + y*668265263) & 0xffffffff
+    h = ((h ^ (h >> 13)) * 1274126177) & 0xffffffff
+    return h ^ (h >> 16)
+
+
+def draw_random(rng, count):
+    """Returns a NumPy array of the next count values of rng.random() (rng
+    is a random.Random), and moves rng past them.  NumPy uses the same
+    Mersenne Twister and turns its output into floats the same way, so
+    its generator is started from the state of rng.
+    """
+    version, internal, gauss_next = rng.getstate()
+    numpy_rng = numpy.random.RandomState()
+    numpy_rng.set_state(('MT19937', numpy.array(internal[:-1], dtype=numpy.uint32), internal[-1]))
+    values = numpy_rng.random_sample(count)
+    keys, position = numpy_rng.get_state()[1:3]
+    rng.setstate((version, tuple([int(key) for key in keys]) + (int(position),), gauss_next))
+    return values
+
+
+
+
+class NoiseEngine(object):
+    """Base class of the noise algorithms a map generator can use.  An engine
+    makes the tile noise and biome noise (2D grids of values, mostly between
+    0 and 255) that the generator turns into tiles.
+    """
+    # Whether the engine can make fused maps (see MapGenerator.set_params())
+    fused = False
+
+
+    def __init__(self, generator):
+        # Map generator using this engine, for its parameters and random numbers
+        self.generator = generator
+
+
+    def draw_map_noise(self, width, height):
+        """Draws any random values a classic map needs from the generator's
+        random number generator, before noise for any rows is made.  Returns
+        them so worker processes can be given the same values.
+        """
+        return None
+
+
+    def set_map_noise(self, data):
+        """Uses random values from draw_map_noise() of another engine."""
+        pass
+
+
+    def forget_map_noise(self):
+        """Drops the random values of a classic map once its noise is made."""
+        pass
+
+
+    def map_noise(self, y_start, y_end):
+        """Returns the tile noise and biome noise of the rows from y_start up
+        to y_end of a classic map.
+        """
+        raise NotImplementedError
+
+
+    def region_noise(self, x, y, width, height):
+        """Returns the tile noise and biome noise of a region of a 'world'
+        mode map.
+        """
+        raise NotImplementedError
+
+
+
+class ValueNoiseEngine(NoiseEngine):
+    """Reference engine; value noise made by interpolating arrays of random
+    values, summed over many octaves.
+    """
+    # Frequency and octaves of the tile noise and of the biome noise
+    tile_noise = (10, 200)
+    biome_noise = (5, 200/3)
+    # Fused maps make both kinds of noise from one noise array
+    fused = True
+
+
+    def __init__(self, generator):
+        NoiseEngine.__init__(self, generator)
+        # Random noise array and its size
+        self.noise = []
+        self.noise_width = 0
+        self.noise_height = 0
+        # Noise arrays of the current classic map (tile noise, biome noise)
+        self.map_arrays = (None, None)
+
+
+    def draw_map_noise(self, width, height):
+        """Draws the random noise arrays of a classic map, the tile noise
+        array first.  Fused maps only need one.
+        """
+        noise = self.draw_noise(width, height)
+        biomenoise = None
+        if not self.generator.params['fused']:
+            biomenoise = self.draw_noise(width, height)
+        self.map_arrays = (noise, biomenoise)
+        return self.map_arrays
+
+
+    def set_map_noise(self, data):
+        noise, biomenoise = data
+        if numpy is not None:
+            # Arrays are used as they are, so forked workers share their memory
+            noise = numpy.asarray(noise, dtype=numpy.float64)
+            if biomenoise is not None:
+                biomenoise = numpy.asarray(biomenoise, dtype=numpy.float64)
+        self.noise_width = len(noise[0])
+        self.noise_height = len(noise)
+        self.map_arrays = (noise, biomenoise)
+
+
+    def forget_map_noise(self):
+        self.noise = []
+        self.map_arrays = (None, None)
+
+
+    def map_noise(self, y_start, y_end):
+        noise, biomenoise = self.map_arrays
+        self.noise = noise
+        if self.generator.params['fused']:
+            return self.fused_turbulence_grid(y_start, y_end)
+        frequency, octaves = self.tile_noise
+        noise = self.turbulence_grid(frequency, octaves, y_start, y_end)
+        self.noise = biomenoise
+        frequency, octaves = self.biome_noise
+        return noise, self.turbulence_grid(frequency, octaves, y_start, y_end)
+
+
+    def region_noise(self, x, y, width, height):
+        if self.generator.params['fused']:
+            return self.fused_world_noise(x, y, width, height)
+        frequency, octaves = self.tile_noise
+        noise = self.world_noise(x, y, width, height, frequency, octaves, 0)
+        frequency, octaves = self.biome_noise
+        return noise, self.world_noise(x, y, width, height, frequency, octaves, 1)
+
+
+    def draw_noise(self, width, height):
+        """Fills the noise array with new random values and returns it.
+        With NumPy the values are drawn all at once (see draw_random()), the
+        same values drawn one at a time without it.
+        """
+        self.noise = []
+        self.noise_width = width
+        self.noise_height = height
+
+        if numpy is not None:
+            values = draw_random(self.generator.rng, width*height)
+            # The same as randint(0, 1000)/1000.0 for each value
+            self.noise = (numpy.floor(values*1001)/1000.0).reshape(height, width)
+            return self.noise
+
+        for y in range(0, self.noise_height):
+            noise_row = []
+            for x in range(0, self.noise_width):
+                noise_row.append(self.generator.rng.randint(0, 1000)/1000.0)
+            self.noise.append(noise_row)
+
+        return self.noise
+
+
+    def turbulence_grid(self, frequency, octaves, y_start=0, y_end=None):
+        """Returns the turbulence value of every tile in the noise array, or
+        only of the rows from y_start up to y_end: the noise array
+        interpolated at the tile's coordinates divided by each octave's size
+        (wrapping around its edges), summed over the octaves weighted by
+        their size.
+        Interpolation is done in two 1D passes (along x, then along y) using
+        index/weight tables built once per axis for each octave.  Uses NumPy
+        array operations when NumPy is available.
+        """
+        if y_end is None:
+            y_end = self.noise_height
+        xs = [x*frequency for x in range(0, self.noise_width)]
+        ys = [y*frequency for y in range(y_start, y_end)]
+        size = octaves * 1.0
+        initial_size = size
+        if numpy is not None:
+            noise = numpy.asarray(self.noise, dtype=numpy.float64)
+        else:
+            noise = self.noise
+        value = self.empty_grid(self.noise_width, y_end - y_start)
+
+        while size >= 1:
+            x_table = self.octave_axis(xs, size, self.noise_width)
+            y_table = self.octave_axis(ys, size, self.noise_height)
+            value = self.add_octave(value, size, noise, x_table, y_table)
+            size /= 2.0
+
+        return self.scale_grid(value, initial_size)
+
+
+    def fused_turbulence_grid(self, y_start=0, y_end=None):
+        """Returns both the tile noise and the biome noise of a fused map
+        from the noise array, in one pass over the octaves.
+        The biome noise uses half the frequency and octaves of the tile
+        noise, so each of its octaves lines up with a tile noise octave and
+        uses the same tables.  It reads the noise array half way across, so
+        the two kinds of noise are not alike.
+        """
+        if y_end is None:
+            y_end = self.noise_height
+        frequency, octaves = self.tile_noise
+        xs = [x*frequency for x in range(0, self.noise_width)]
+        ys = [y*frequency for y in range(y_start, y_end)]
+        size = octaves * 1.0
+        initial_size = size
+        if numpy is not None:
+            noise = numpy.asarray(self.noise, dtype=numpy.float64)
+        else:
+            noise = self.noise
+        value = self.empty_grid(self.noise_width, y_end - y_start)
+        biome_value = self.empty_grid(self.noise_width, y_end - y_start)
+
+        while size >= 1:
+            x_table = self.octave_axis(xs, size, self.noise_width)
+            y_table = self.octave_axis(ys, size, self.noise_height)
+            value = self.add_octave(value, size, noise, x_table, y_table)
+            if size / 2.0 >= 1:
+                biome_x_table = self.shift_axis(x_table, self.noise_width/2, self.noise_width)
+                biome_y_table = self.shift_axis(y_table, self.noise_height/2, self.noise_height)
+                biome_value = self.add_octave(biome_value, size / 2.0, noise, biome_x_table, biome_y_table)
+            size /= 2.0
+
+        return self.scale_grid(value, initial_size), self.scale_grid(biome_value, initial_size / 2.0)
+
+
+    def fused_world_noise(self, x, y, width, height):
+        """Returns both the tile noise and the biome noise of a region of a
+        fused 'world' mode map, sharing the tables of each octave like
+        fused_turbulence_grid() does.
+        """
+        frequency, octaves = self.tile_noise
+        xs = [tx*frequency for tx in range(x, x+width)]
+        ys = [ty*frequency for ty in range(y, y+height)]
+        size = octaves * 1.0
+        initial_size = size
+        key = self.generator.field_key(0)
+        biome_key = self.generator.field_key(1)
+        value = self.empty_grid(width, height)
+        biome_value = self.empty_grid(width, height)
+
+        while size >= 1:
+            x_table, columns = self.world_axis(xs, size)
+            y_table, rows = self.world_axis(ys, size)
+            value = self.add_octave(value, size, self.world_lattice(key, columns, rows), x_table, y_table)
+            if size / 2.0 >= 1:
+                noise = self.world_lattice(biome_key, columns, rows)
+                biome_value = self.add_octave(biome_value, size / 2.0, noise, x_table, y_table)
+            size /= 2.0
+
+        return self.scale_grid(value, initial_size), self.scale_grid(biome_value, initial_size / 2.0)
+
+
+    def world_noise(self, x, y, width, height, frequency, octaves, field):
+        """Returns the turbulence values of a region of a 'world' mode map.
+        Instead of a wrapped noise array, the noise at each lattice point is a
+        hash of the seed, the field number and the point's coordinates, so
+        any region can be generated on its own.
+        """
+        xs = [tx*frequency for tx in range(x, x+width)]
+        ys = [ty*frequency for ty in range(y, y+height)]
+        size = octaves * 1.0
+        initial_size = size
+        key = self.generator.field_key(field)
+        value = self.empty_grid(width, height)
+
+        while size >= 1:
+            x_table, columns = self.world_axis(xs, size)
+            y_table, rows = self.world_axis(ys, size)
+            noise = self.world_lattice(key, columns, rows)
+            value = self.add_octave(value, size, noise, x_table, y_table)
+            size /= 2.0
+
+        return self.scale_grid(value, initial_size)
+
+
+    def world_lattice(self, key, columns, rows):
+        """Returns the hashed noise values at the given lattice columns and
+        rows, in the same format the noise array uses.
+        """
+        if numpy is not None:
+            hashed = lattice_hash(key, numpy.array(columns, dtype=numpy.int64)[numpy.newaxis,:],
+                                  numpy.array(rows, dtype=numpy.int64)[:,numpy.newaxis])
+            return (hashed % 1001) / 1000.0
+        return [[(lattice_hash(key, i, j) % 1001) / 1000.0 for i in columns] for j in rows]
+
+
+    def empty_grid(self, width, height):
+        """Returns a zeroed grid for accumulating octaves into."""
+        if numpy is not None:
+            return numpy.zeros((height, width))
+        return [[0.0] * width for y in range(0, height)]
+
+
+    def scale_grid(self, value, initial_size):
+        """Scales accumulated octaves to the final turbulence values."""
+        if numpy is not None:
+            return 128.0 * value / initial_size
+        return [[128.0 * v / initial_size for v in value_row] for value_row in value]
+
+
+    def add_octave(self, value, size, noise, x_table, y_table):
+        """Interpolates one octave of the noise array using the tables from
+        octave_axis(), and adds it (scaled by size) to the accumulated value.
+        """
+        x1, x2, fractX, invX = x_table
+        y1, y2, fractY, invY = y_table
+
+        if numpy is not None:
+            x1, x2, fractX, invX = [numpy.array(t) for t in x_table]
+            y1, y2, fractY, invY = [numpy.array(t) for t in y_table]
+            # Interpolate along x, only for the noise rows this octave uses
+            used, position = numpy.unique(numpy.concatenate((y1, y2)), return_inverse=True)
+            used = noise[used]
+            rows = fractX * used[:,x1] + invX * used[:,x2]
+            y1 = position[:len(y1)]
+            y2 = position[len(y1):]
+            # Interpolate those rows along y and add them to the total
+            value += (fractY[:,numpy.newaxis] * rows[y1] + invY[:,numpy.newaxis] * rows[y2]) * size
+            return value
+
+        weights_x = zip(x1, x2, fractX, invX)
+        # Interpolate along x, only for the noise rows this octave uses
+        rows = {}
+        for n in set(y1) | set(y2):
+            noise_row = noise[n]
+            rows[n] = [fx*noise_row[i1] + ix*noise_row[i2] for i1, i2, fx, ix in weights_x]
+        # Interpolate those rows along y and add them to the total
+        for y, value_row in enumerate(value):
+            row1 = rows[y1[y]]
+            row2 = rows[y2[y]]
+            fy = fractY[y]
+            iy = invY[y]
+            value[y] = [v + (fy*a + iy*b) * size for v, a, b in zip(value_row, row1, row2)]
+        return value
+
+
+    def octave_axis(self, coords, size, length):
+        """Builds the interpolation tables for one axis of an octave.  Returns
+        lists of the two neighboring noise indices and their weights for each
+        coordinate.
+        """
+        index1 = []
+        index2 = []
+        fract = []
+        inverse = []
+        for c in coords:
+            c = c / size
+            f = c-int(c)
+            i1 = (int(c)+length) % length
+            index1.append(i1)
+            index2.append((i1+length - 1) % length)
+            fract.append(f)
+            inverse.append(1-f)
+        return index1, index2, fract, inverse
+
+
+    def shift_axis(self, table, offset, length):
+        """Returns a copy of an octave_axis() table that reads the noise
+        array offset places further along.
+        """
+        index1, index2, fract, inverse = table
+        index1 = [(i + offset) % length for i in index1]
+        index2 = [(i + offset) % length for i in index2]
+        return index1, index2, fract, inverse
+
+
+    def world_axis(self, coords, size):
+        """Builds the interpolation tables for one axis of a 'world' mode
+        octave.  Works like octave_axis() without wrapping around, and also
+        returns the lattice points used; the indices in the tables are
+        positions in that list.
+        """
+        index1 = []
+        fract = []
+        inverse = []
+        for c in coords:
+            c = c / size
+            i1 = int(math.floor(c))
+            f = c-i1
+            index1.append(i1)
+            fract.append(f)
+            inverse.append(1-f)
+        # Only the lattice points that are actually used
+        points = sorted(set(index1) | set(i1 - 1 for i1 in index1))
+        position = dict((p, n) for n, p in enumerate(points))
+        index2 = [position[i1 - 1] for i1 in index1]
+        index1 = [position[i1] for i1 in index1]
+        return (index1, index2, fract, inverse), points
+
+
+
+class SimplexNoiseEngine(NoiseEngine):
+    """Gradient noise engine using 2D simplex noise.  Gradients are picked by
+    hashing lattice coordinates, so the noise never repeats and a classic map
+    is the region of the noise at the origin.  Simplex noise is smooth, so a
+    few octaves look about as good as the value engine's many octaves.
+    """
+    # Size (in tiles) of the largest features and number of octaves of the
+    # tile noise and of the biome noise
+    tile_noise = (20.0, 4)
+    biome_noise = (13.0, 3)
+    # Scales summed octaves to about the spread of the value engine's noise
+    gain = 52.0
+    # Skewing factors between the square grid and the simplex grid
+    skew = 0.5 * (math.sqrt(3.0) - 1.0)
+    unskew = (3.0 - math.sqrt(3.0)) / 6.0
+    # Gradient directions, picked by the lowest 3 bits of the lattice hash
+    gradients = ((1, 1), (-1, 1), (1, -1), (-1, -1), (1, 0), (-1, 0), (0, 1), (0, -1))
+
+
+    def __init__(self, generator):
+        NoiseEngine.__init__(self, generator)
+        # X and Y parts of the gradients, for simplex_grid()
+        if numpy is not None:
+            self.gradient_array = numpy.array(self.gradients, dtype=numpy.float64).T.copy()
+
+
+    def map_noise(self, y_start, y_end):
+        return self.region_noise(0, y_start, self.generator.params['width'], y_end - y_start)
+
+
+    def region_noise(self, x, y, width, height):
+        return (self.fractal(x, y, width, height, self.tile_noise, self.generator.field_key(0)),
+                self.fractal(x, y, width, height, self.biome_noise, self.generator.field_key(1)))
+
+
+    def fractal(self, x, y, width, height, settings, key):
+        """Returns the sum of the octaves of simplex noise for a region, each
+        octave at twice the frequency and half the strength of the last.
+        """
+        scale, octaves = settings
+        frequency = 1.0 / scale
+        amplitude = 1.0
+        if numpy is not None:
+            xs = numpy.arange(x, x+width, dtype=numpy.float64)[numpy.newaxis,:]
+            ys = numpy.arange(y, y+height, dtype=numpy.float64)[:,numpy.newaxis]
+            value = numpy.zeros((height, width))
+        else:
+            value = [[0.0] * width for ty in range(0, height)]
+
+        for octave in range(0, octaves):
+            # Every octave gets its own gradients
+            octave_key = (key + octave*0x632be5ab) & 0xffffffff
+            if numpy is not None:
+                value += amplitude * self.simplex_grid(xs * frequency, ys * frequency, octave_key)
+            else:
+                value = [[v + amplitude * self.simplex(tx * frequency, ty * frequency, octave_key)
+                          for tx, v in zip(range(x, x+width), value_row)]
+                         for ty, value_row in zip(range(y, y+height), value)]
+            amplitude *= 0.5
+            frequency *= 2.0
+
+        if numpy is not None:
+            return 128.0 + self.gain * value
+        return [[128.0 + self.gain * v for v in value_row] for value_row in value]
+
+
+    def simplex(self, x, y, key):
+        """Returns the simplex noise value (-1 to 1) at the point (x, y)."""
+        # Find the simplex (triangle) the point is in
+        s = (x + y) * self.skew
+        i = math.floor(x + s)
+        j = math.floor(y + s)
+        t = (i + j) * self.unskew
+        x0 = x - (i - t)
+        y0 = y - (j - t)
+        if x0 > y0:
+            i1, j1 = 1, 0
+        else:
+            i1, j1 = 0, 1
+        # Offsets from the other two corners
+        x1 = x0 - i1 + self.unskew
+        y1 = y0 - j1 + self.unskew
+        x2 = x0 - 1.0 + 2.0 * self.unskew
+        y2 = y0 - 1.0 + 2.0 * self.unskew
+        i = int(i)
+        j = int(j)
+        value = self.corner(x0, y0, i, j, key)
+        value += self.corner(x1, y1, i+i1, j+j1, key)
+        value += self.corner(x2, y2, i+1, j+1, key)
+        return 70.0 * value
+
+
+    def corner(self, x, y, i, j, key):
+        """Returns the part of the noise value from one simplex corner."""
+        t = 0.5 - x*x - y*y
+        if t <= 0:
+            return 0.0
+        gx, gy = self.gradients[lattice_hash(key, i, j) & 7]
+        t *= t
+        return t * t * (gx*x + gy*y)
+
+
+    def simplex_grid(self, x, y, key):
+        """Vectorized simplex() for NumPy arrays of points."""
+        s = (x + y) * self.skew
+        i = numpy.floor(x + s)
+        j = numpy.floor(y + s)
+        t = (i + j) * self.unskew
+        x0 = x - (i - t)
+        y0 = y - (j - t)
+        i1 = numpy.where(x0 > y0, 1, 0)
+        j1 = 1 - i1
+        x1 = x0 - i1 + self.unskew
+        y1 = y0 - j1 + self.unskew
+        x2 = x0 - 1.0 + 2.0 * self.unskew
+        y2 = y0 - 1.0 + 2.0 * self.unskew
+        # Hash each lattice point of the area once, instead of once per corner
+        i = i.astype(numpy.int64)
+        j = j.astype(numpy.int64)
+        i_min = i.min()
+        j_min = j.min()
+        lattice_i = numpy.arange(i_min, i.max() + 2, dtype=numpy.int64)[numpy.newaxis,:]
+        lattice_j = numpy.arange(j_min, j.max() + 2, dtype=numpy.int64)[:,numpy.newaxis]
+        gradients = lattice_hash(key, lattice_i, lattice_j) & 7
+        i -= i_min
+        j -= j_min
+        value = self.corner_grid(x0, y0, gradients[j, i])
+        value += self.corner_grid(x1, y1, gradients[j+j1, i+i1])
+        value += self.corner_grid(x2, y2, gradients[j+1, i+1])
+        return 70.0 * value
+
+
+    def corner_grid(self, x, y, gradient):
+        """Vectorized corner() for NumPy arrays of points."""
+        t = 0.5 - x*x - y*y
+        inside = t > 0
+        gx = self.gradient_array[0][gradient]
+        gy = self.gradient_array[1][gradient]
+        t *= t
+        return numpy.where(inside, t * t * (gx*x + gy*y), 0.0)
+
+
+
+# Noise engines by the names used for them in the generator parameters
+engines = {
+    "value" : ValueNoiseEngine,
+    "simplex" : SimplexNoiseEngine
+    }
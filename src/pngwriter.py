@@ -0,0 +1,147 @@
+#!/usr/bin/python
+"""Writes PNG images a few rows at a time, so the whole image never has to be
+in memory at once.
+"""
+import struct
+import zlib
+
+
+# Bytes every PNG file starts with
+signature = "\x89PNG\r\n\x1a\n"
+# Largest prime below 2**16, the modulus of Adler-32 checksums
+adler_base = 65521
+
+
+
+def deflate_rows(rows, level=6):
+    """Compresses rows of pixels for PNGWriter.write_deflated(), so they can
+    be compressed somewhere else (e.g. in another process).  Returns the
+    compressed data, the Adler-32 checksum and size of the uncompressed data,
+    and the number of rows.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    parts = []
+    checksum = 1
+    size = 0
+    count = 0
+    for row in rows:
+        # Each row starts with its filter type (0, none)
+        for data in ("\0", row):
+            parts.append(compressor.compress(data))
+            checksum = zlib.adler32(data, checksum)
+            size += len(data)
+        count += 1
+    # End on a byte boundary, so more compressed data can follow
+    parts.append(compressor.flush(zlib.Z_FULL_FLUSH))
+    return "".join(parts), checksum & 0xffffffff, size, count
+
+
+def combine_adler(first, second, second_size):
+    """Returns the Adler-32 checksum of two pieces of data, given the
+    checksums of both pieces and the size of the second piece.
+    """
+    remainder = second_size % adler_base
+    sum1 = ((first & 0xffff) + (second & 0xffff) - 1) % adler_base
+    sum2 = (remainder*(first & 0xffff) + (first >> 16) + (second >> 16) - remainder) % adler_base
+    return (sum2 << 16) | sum1
+
+
+
+class PNGWriter(object):
+    """Writes an 8 bit RGB PNG image to a file.  Rows are compressed and
+    written as they are given, from top to bottom.
+    """
+    # Compressed data is collected until there is this much, then written as one chunk
+    chunk_size = 1 << 16
+
+
+    def __init__(self, f, width, height, level=6):
+        # File object the image is written to
+        self.file = f
+        # Dimensions in pixels
+        self.width = width
+        self.height = height
+        # Compression level (0-9)
+        self.level = level
+        # Number of rows written so far
+        self.rows_written = 0
+        # Compressor of the image data, kept across rows (raw deflate data,
+        # so data compressed by deflate_rows() can be added in between)
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        # Adler-32 checksum of the uncompressed image data
+        self.checksum = 1
+        # Compressed data not written to the file yet (starting with the zlib header)
+        self.pending = ["\x78\x9c"]
+        self.pending_size = 2
+        # File header and image header (8 bit depth, RGB, no interlacing)
+        self.file.write(signature)
+        self.write_chunk("IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+
+
+    def write_rows(self, rows):
+        """Writes an iterable of rows, each a string of the RGB bytes of the
+        pixels of one row.
+        """
+        for row in rows:
+            if len(row) != 3*self.width:
+                raise ValueError("Row has {0} bytes, expected {1}".format(len(row), 3*self.width))
+            self.count_rows(1)
+            # Each row starts with its filter type (0, none)
+            for data in ("\0", row):
+                self.add_data(self.compressor.compress(data))
+                self.checksum = zlib.adler32(data, self.checksum)
+
+
+    def write_deflated(self, data, checksum, size, rows):
+        """Writes rows compressed by deflate_rows(), given all of its return
+        values.
+        """
+        if size != rows*(1 + 3*self.width):
+            raise ValueError("Compressed rows do not match the image width")
+        self.count_rows(rows)
+        # Finish the data compressed here so far on a byte boundary first
+        self.add_data(self.compressor.flush(zlib.Z_FULL_FLUSH))
+        self.add_data(data)
+        self.checksum = combine_adler(self.checksum & 0xffffffff, checksum, size)
+
+
+    def count_rows(self, rows):
+        """Counts rows about to be written, checking they fit in the image."""
+        if self.rows_written + rows > self.height:
+            raise ValueError("The image only has {0} rows".format(self.height))
+        self.rows_written += rows
+
+
+    def close(self):
+        """Writes the rest of the image.  Does not close the file."""
+        if self.rows_written != self.height:
+            raise ValueError("Only {0} of {1} rows have been written".format(self.rows_written, self.height))
+        self.add_data(self.compressor.flush())
+        self.add_data(struct.pack(">I", self.checksum & 0xffffffff))
+        self.flush_data()
+        self.write_chunk("IEND", "")
+
+
+    def add_data(self, data):
+        """Collects compressed image data, writing it once there is enough."""
+        if data:
+            self.pending.append(data)
+            self.pending_size += len(data)
+            if self.pending_size >= self.chunk_size:
+                self.flush_data()
+
+
+    def flush_data(self):
+        """Writes the collected compressed image data as an IDAT chunk."""
+        if self.pending:
+            self.write_chunk("IDAT", "".join(self.pending))
+            self.pending = []
+            self.pending_size = 0
+
+
+    def write_chunk(self, chunk_type, data):
+        """Writes a chunk: its length, type, data and checksum."""
+        self.file.write(struct.pack(">I", len(data)))
+        self.file.write(chunk_type)
+        self.file.write(data)
+        self.file.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(chunk_type)) & 0xffffffff))
@@ -0,0 +1,80 @@
+#!/usr/bin/python
+"""Saves maps in a background thread, so the display window stays responsive
+while a map is saved.
+"""
+import threading
+
+import pygame
+
+import mapfile
+
+
+# Type of the events posted to the pygame event queue when a save job makes
+# progress or finishes (the event's job attribute is the SaveJob)
+save_event = pygame.USEREVENT
+
+
+
+class SaveJob(object):
+    """Saves the image and map file of a map in a background thread.  The
+    tile map is copied when the job is created, so it can keep changing
+    while it is saved.  Both files are written to temporary files first,
+    which then replace the old files.
+    """
+    # Part of the progress of a save spent writing the map image, the rest is writing the map file
+    image_part = 0.9
+
+
+    def __init__(self, graphics, path, params, tile_map, map_format):
+        # Graphics object that renders the map image
+        self.graphics = graphics
+        # Path of the saved files, without the extensions
+        self.path = path
+        # Generator data saved with the map, and the format of the map file
+        self.params = dict(params)
+        self.map_format = map_format
+        # Tile map being saved, and the copy of it that is written
+        self.tile_map = tile_map
+        self.snapshot = tile_map.copy()
+        # Part of the save done so far (0 to 1)
+        self.progress = 0.0
+        # Whether the save is over, and the exception that stopped it (if any)
+        self.done = False
+        self.error = None
+        # Thread doing the save
+        self.thread = threading.Thread(target=self.run)
+        self.thread.start()
+
+
+    def run(self):
+        """Saves the map (in the background thread)."""
+        try:
+            self.graphics.save_full_map(self.path + ".png", tile_map=self.snapshot, progress=self.image_progress)
+            mapfile.save_map(self.path + mapfile.extensions[self.map_format], self.params,
+                self.snapshot, self.map_format)
+            self.progress = 1.0
+        except Exception as error:
+            self.error = error
+        self.done = True
+        pygame.event.post(pygame.event.Event(save_event, job=self))
+
+
+    def image_progress(self, part):
+        """Records the progress of writing the map image, posting an event
+        each time another percent of the save is done.
+        """
+        progress = part*self.image_part
+        if int(progress*100) != int(self.progress*100):
+            pygame.event.post(pygame.event.Event(save_event, job=self))
+        self.progress = progress
+
+
+    def finish(self):
+        """Waits for the save to end, and hands changes that were not saved
+        (if any) back to the tile map.  Returns the exception that stopped
+        the save, or None if it succeeded.
+        """
+        self.thread.join()
+        if hasattr(self.tile_map.data, "saved"):
+            self.tile_map.data.saved(self.snapshot.data)
+        return self.error
@@ -0,0 +1,70 @@
+#!/usr/bin/python
+"""Tile textures cut from a texture atlas, one image with the textures of
+all tiles in a grid.
+"""
+import os
+import json
+
+import pygame
+
+
+
+class TextureAtlas(object):
+    """Tile textures loaded from one atlas image.  The atlas is described by
+    a JSON file like:
+
+    {"image": "atlas.png", "tile_size": 32,
+     "tiles": {"water": [0, 0], "sand": [1, 0], "grass": [2, 0]}}
+
+    where "image" is relative to the JSON file and each tile name gives the
+    column and row of its texture in the atlas image.
+    """
+    def __init__(self, path):
+        with open(path, 'r') as f:
+            description = json.load(f)
+        # Image with the textures of all tiles
+        self.image = pygame.image.load(os.path.join(os.path.dirname(path), description["image"]))
+        # Size of each texture in the atlas image, in pixels
+        self.tile_size = int(description["tile_size"])
+        # Part of the atlas image of each tile, by tile name
+        self.textures = {}
+        for name, (column, row) in description["tiles"].items():
+            rect = (column*self.tile_size, row*self.tile_size, self.tile_size, self.tile_size)
+            self.textures[name] = self.image.subsurface(rect)
+        # Textures made by textures_for(), by tile size and palette
+        self.scaled = {}
+
+
+    def textures_for(self, palette, colors, size):
+        """Returns the textures of a tile map palette, indexed by tile ID and
+        scaled to size x size pixels.  Tiles without a texture get a surface
+        of their color from colors.  Textures are made and converted to the
+        display's pixel format once, then reused.
+        """
+        key = (size, tuple(palette))
+        if key not in self.scaled:
+            textures = []
+            for name, color in zip(palette, colors):
+                if name in self.textures:
+                    texture = pygame.transform.scale(self.textures[name], (size, size))
+                else:
+                    texture = pygame.Surface((size, size))
+                    texture.fill(color)
+                # Converting needs a display
+                if pygame.display.get_surface() is not None:
+                    texture = texture.convert()
+                textures.append(texture)
+            self.scaled[key] = textures
+        return self.scaled[key]
+
+
+
+def blit_all(surface, blits):
+    """Draws a list of (source, position) pairs to a surface, in one call
+    where pygame supports it (Surface.blits, pygame 1.9.4 or later).
+    """
+    if hasattr(surface, "blits"):
+        surface.blits(blits, False)
+    else:
+        for source, position in blits:
+            surface.blit(source, position)
@@ -0,0 +1,152 @@
+#!/usr/bin/python
+import itertools
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+
+class TileMap(object):
+    """Grid of tiles stored as one byte (a tile ID) per tile, with a palette
+    that maps tile IDs to tile names.  Rows can be read like the rows of a
+    2D list of tile names, so code written for lists of lists keeps working.
+    """
+    # Tile names of the tile IDs every new map starts with
+    default_palette = ("none", "water", "sand", "mountainhigh", "forest", "grass")
+    # Source of version numbers, shared so no two tile map states have the same version
+    versions = itertools.count()
+
+
+    def __init__(self, width, height, palette=default_palette, data=None):
+        # Dimensions in tiles
+        self.width = width
+        self.height = height
+        # Tile names, indexed by tile ID
+        self.palette = list(palette)
+        # Tile IDs, indexed by tile name
+        self.ids = dict((name, n) for n, name in enumerate(self.palette))
+        # Tile IDs of every tile, row by row
+        if data is None:
+            data = bytearray(width*height)
+        self.data = data
+        # Version number of the current tiles, changes whenever tiles change
+        self.version = next(TileMap.versions)
+
+
+    @classmethod
+    def from_lists(cls, rows, palette=default_palette):
+        """Creates a tile map from a 2D list of tile names."""
+        width = len(rows[0]) if rows else 0
+        tile_map = cls(width, len(rows), palette)
+        for y, row in enumerate(rows):
+            tile_map.set_row(y, row)
+        return tile_map
+
+
+    def tile_id(self, name):
+        """Returns the ID of a tile name, adding the name to the palette if it
+        is not in it yet.
+        """
+        try:
+            return self.ids[name]
+        except KeyError:
+            if len(self.palette) >= 256:
+                raise ValueError("A tile map can not have more than 256 tile types")
+            self.ids[name] = len(self.palette)
+            self.palette.append(name)
+            return self.ids[name]
+
+
+    def get(self, x, y):
+        """Returns the name of the tile at (x, y)."""
+        return self.palette[self.data[y*self.width + x]]
+
+
+    def set(self, x, y, name):
+        """Changes the tile at (x, y)."""
+        self.data[y*self.width + x] = self.tile_id(name)
+        self.changed()
+
+
+    def get_row(self, y):
+        """Returns a list of the tile names in row y."""
+        palette = self.palette
+        start = y*self.width
+        return [palette[i] for i in self.data[start:start+self.width]]
+
+
+    def set_row(self, y, names):
+        """Changes all tiles of row y to the given list of tile names."""
+        start = y*self.width
+        self.data[start:start+self.width] = bytearray(self.tile_id(name) for name in names)
+        self.changed()
+
+
+    def paste(self, other, x, y):
+        """Copies all tiles of another tile map into this one, with the top
+        left corner of the other map at (x, y).
+        """
+        # Translate the other map's tile IDs if the palettes differ
+        table = None
+        if self.palette[:len(other.palette)] != other.palette:
+            table = bytearray(256)
+            for n, name in enumerate(other.palette):
+                table[n] = self.tile_id(name)
+            table = str(table)
+        for row in range(0, other.height):
+            tiles = other.data[row*other.width:(row+1)*other.width]
+            if table is not None:
+                tiles = tiles.translate(table)
+            start = (y+row)*self.width + x
+            self.data[start:start+other.width] = tiles
+        self.changed()
+
+
+    def changed(self):
+        """Gives the tile map a new version number.  Must be called after
+        changing the tile IDs in data directly.
+        """
+        self.version = next(TileMap.versions)
+
+
+    def copy(self):
+        """Returns a copy of the tile map (e.g. a snapshot to save while the
+        tile map keeps changing).
+        """
+        if hasattr(self.data, "copy"):
+            data = self.data.copy()
+        else:
+            data = bytearray(self.data[:])
+        return TileMap(self.width, self.height, self.palette, data)
+
+
+    def as_array(self):
+        """Returns a NumPy array of the tile IDs that shares memory with
+        this tile map (requires NumPy, and tile IDs that are all in memory,
+        not read from a map file as they are used).
+        """
+        return numpy.frombuffer(self.data, dtype=numpy.uint8).reshape(self.height, self.width)
+
+
+    def to_lists(self):
+        """Returns the tiles as a 2D list of tile names."""
+        return [self.get_row(y) for y in range(0, self.height)]
+
+
+    def __len__(self):
+        return self.height
+
+
+    def __getitem__(self, y):
+        if y < 0:
+            y += self.height
+        if not 0 <= y < self.height:
+            raise IndexError("tile map row out of range")
+        return self.get_row(y)
+
+
+    def __iter__(self):
+        for y in range(0, self.height):
+            yield self.get_row(y)